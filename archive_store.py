@@ -0,0 +1,311 @@
+import hashlib
+import io
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from gridfs import GridFSBucket
+
+from artifact_cache import hash_file
+
+# Archives live in GridFS buckets named after the old single-document collections
+# (e.g. zip_files.json_files_fs.files / .chunks). The old collection name now only
+# holds one small metadata record per archive pointing at its GridFS file.
+BUCKET_SUFFIX = "_fs"
+
+# Folder archives are packed by size: consecutive files go into one archive until it would pass
+# archive_target_mb (a single larger file gets an archive of its own)
+archive_target_bytes = int(float(os.getenv("archive_target_mb", "32")) * 1024 * 1024)
+# Deflate level (1-9) for members that still compress, such as JSON
+archive_deflate_level = int(os.getenv("archive_deflate_level", "6"))
+# Archives compressed and uploaded at the same time; zlib and the network release the GIL
+archive_workers = int(os.getenv("archive_workers", "4"))
+
+# archive_publish_mode=zip uploads every folder archive as a zip. archive_publish_mode=delta stores
+# each member file once in the content-addressed "blobs" bucket (named by its sha256) and records,
+# per collection and run, a manifest listing every archive's members; unchanged files are not
+# uploaded again and rebuild_archive produces the zip on demand. Unreferenced blobs are collected
+# once a run is published.
+archive_publish_mode = os.getenv("archive_publish_mode", "zip")
+BLOB_BUCKET = "blobs"
+MANIFEST_COLLECTION = "manifests"
+# Unreferenced blobs younger than this are kept: a concurrent run may not have written its manifest yet
+blob_gc_grace_seconds = int(os.getenv("blob_gc_grace_seconds", "3600"))
+
+# Formats that are already compressed; deflating them again costs CPU and saves almost nothing
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".xlsx", ".zip", ".gz", ".parquet", ".arrow"}
+
+# Function to build an id shared by every archive uploaded in the same workflow run attempt.
+# A re-run keeps GITHUB_RUN_ID, so the attempt is part of the id; otherwise a failed attempt's partial
+# archives would share the re-run's id and survive delete_old_archives. Outside GitHub every
+# invocation (process) gets its own id.
+local_run_id = f"{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}-{ObjectId()}"
+
+def get_run_id():
+    github_run_id = os.getenv("GITHUB_RUN_ID")
+    if github_run_id:
+        return f"{github_run_id}-{os.getenv('GITHUB_RUN_ATTEMPT', '1')}"
+    return local_run_id
+
+# Function to get the GridFS bucket backing an archive collection
+def get_archive_bucket(zip_db, collection_name):
+    return GridFSBucket(zip_db, bucket_name=f"{collection_name}{BUCKET_SUFFIX}")
+
+# Write-only stream that uploads to GridFS chunk by chunk while the zip is being produced.
+# It has no tell()/seek(), so zipfile.ZipFile treats it as unseekable and streams into it.
+class GridFSArchiveSink:
+    def __init__(self, zip_db, collection_name, filename, run_id=None):
+        self.zip_db = zip_db
+        self.collection_name = collection_name
+        self.filename = filename
+        self.run_id = run_id or get_run_id()
+        self.size = 0
+        self.file_id = None
+        self._sha256 = hashlib.sha256()
+        self._grid_in = get_archive_bucket(zip_db, collection_name).open_upload_stream(filename)
+
+    def write(self, data):
+        self._grid_in.write(data)
+        self._sha256.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.file_id is not None:
+            return
+        checksum = self._sha256.hexdigest()
+        self._grid_in.metadata = {"run_id": self.run_id, "size": self.size, "sha256": checksum}
+        self._grid_in.close()
+        self.file_id = self._grid_in._id
+        self.zip_db[self.collection_name].insert_one({
+            "filename": self.filename,
+            "gridfs_id": self.file_id,
+            "size": self.size,
+            "sha256": checksum,
+            "run_id": self.run_id,
+            "uploaded_at": datetime.now(timezone.utc)
+        })
+        print(f"Archive '{self.filename}' uploaded to GridFS ({self.size / 1024:.1f} KB, sha256 {checksum[:12]}).")
+
+    def abort(self):
+        self._grid_in.abort()
+        print(f"Upload of archive '{self.filename}' aborted.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+# Function to upload an existing local file to GridFS without reading it into memory
+def upload_archive_file(zip_db, collection_name, file_path, filename=None, run_id=None, chunk_size=1024 * 1024):
+    with GridFSArchiveSink(zip_db, collection_name, filename or os.path.basename(file_path), run_id) as sink:
+        with open(file_path, 'rb') as file_data:
+            for chunk in iter(lambda: file_data.read(chunk_size), b""):
+                sink.write(chunk)
+    return sink
+
+# Function to pick the zip compression of a member from its file type
+def get_compress_type(path):
+    return zipfile.ZIP_STORED if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+# Function to zip (path, arcname) pairs straight into a GridFS upload stream, without a local zip file.
+# Already-compressed members are stored, the rest deflated at archive_deflate_level.
+def upload_files_as_zip(zip_db, collection_name, files, filename, run_id=None):
+    with GridFSArchiveSink(zip_db, collection_name, filename, run_id) as sink:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, compresslevel=archive_deflate_level) as zipf:
+            for file_path, arcname in files:
+                zipf.write(file_path, arcname, compress_type=get_compress_type(file_path))
+    return sink
+
+# Function to zip a directory straight into a GridFS upload stream, without a local zip file
+def upload_directory_as_zip(zip_db, collection_name, directory_path, filename, run_id=None):
+    files = []
+    for root, dirs, file_names in os.walk(directory_path):
+        for file in file_names:
+            file_path = os.path.join(root, file)
+            files.append((file_path, os.path.relpath(file_path, directory_path)))
+    sink = upload_files_as_zip(zip_db, collection_name, files, filename, run_id)
+    print(f"Directory '{directory_path}' has been zipped into '{filename}'.")
+    return sink
+
+# Function to split files, in order, into consecutive groups of about target_bytes each
+def pack_files_by_size(file_paths, target_bytes=None):
+    target_bytes = target_bytes or archive_target_bytes
+    groups = []
+    group_size = 0
+    for file_path in file_paths:
+        size = os.path.getsize(file_path)
+        if not groups or (group_size + size > target_bytes and group_size > 0):
+            groups.append([])
+            group_size = 0
+        groups[-1].append(file_path)
+        group_size += size
+    return groups
+
+# Function to upload several archives at once; archives is a list of (filename, [(path, arcname), ...]).
+# With archive_publish_mode=delta only their manifest entries and new blobs are written.
+def upload_archives(zip_db, collection_name, archives, run_id=None, workers=None):
+    if archive_publish_mode == "delta":
+        return publish_archive_manifests(zip_db, collection_name, archives, run_id, workers)
+    workers = max(min(workers or archive_workers, len(archives)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sinks = list(executor.map(
+            lambda archive: upload_files_as_zip(zip_db, collection_name, archive[1], archive[0], run_id), archives))
+    for (filename, files), sink in zip(archives, sinks):
+        print(f"Zip file '{filename}' ({len(files)} files, {sink.size / 1024:.1f} KB) has been saved to MongoDB successfully.")
+    return sinks
+
+# Function to pack files into size-bounded archives named folder_1.zip, folder_2.zip, ... and
+# upload them in parallel. Members keep only their file name.
+def build_archives(zip_db, collection_name, file_paths, run_id=None, target_bytes=None, workers=None, first_number=1):
+    archives = [(f"folder_{number}.zip", [(file_path, os.path.basename(file_path)) for file_path in group])
+                for number, group in enumerate(pack_files_by_size(file_paths, target_bytes), start=first_number)]
+    return upload_archives(zip_db, collection_name, archives, run_id, workers)
+
+# Function to delete archives (metadata records and GridFS files) from older runs
+def delete_old_archives(zip_db, collection_name, keep_run_id=None):
+    bucket = get_archive_bucket(zip_db, collection_name)
+    query = {} if keep_run_id is None else {"run_id": {"$ne": keep_run_id}}
+    deleted = 0
+    for record in zip_db[collection_name].find(query):
+        if "gridfs_id" in record:
+            bucket.delete(record["gridfs_id"])
+        zip_db[collection_name].delete_one({"_id": record["_id"]})
+        deleted += 1
+    print(f"Deleted {deleted} old archive(s) from '{collection_name}'.")
+    if archive_publish_mode == "delta" and keep_run_id is not None:
+        finish_manifest(zip_db, collection_name, keep_run_id)
+    return deleted
+
+# Function to get the content-addressed blob bucket
+def get_blob_bucket(zip_db):
+    return GridFSBucket(zip_db, bucket_name=BLOB_BUCKET)
+
+# Function to store a file as a blob unless one with the same content exists.
+# Returns (sha256, size, bytes uploaded).
+def store_blob(zip_db, file_path):
+    sha256 = hash_file(file_path)
+    size = os.path.getsize(file_path)
+    if zip_db[f"{BLOB_BUCKET}.files"].find_one({"filename": sha256}, projection={"_id": 1}) is not None:
+        return sha256, size, 0
+    with open(file_path, 'rb') as f:
+        get_blob_bucket(zip_db).upload_from_stream(sha256, f, metadata={"size": size})
+    return sha256, size, size
+
+# Result of publishing one archive as a manifest entry; size is the number of bytes actually uploaded
+class ManifestArchive:
+    def __init__(self, filename, members, size):
+        self.filename = filename
+        self.members = members
+        self.size = size
+
+# Function to add archives to this run's manifest of a collection, uploading only the blobs not stored yet
+def publish_archive_manifests(zip_db, collection_name, archives, run_id=None, workers=None):
+    run_id = run_id or get_run_id()
+    file_paths = list(dict.fromkeys(file_path for _, files in archives for file_path, _ in files))
+    workers = max(min(workers or archive_workers, len(file_paths)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stored = dict(zip(file_paths, executor.map(lambda file_path: store_blob(zip_db, file_path), file_paths)))
+
+    entries = []
+    results = []
+    for filename, files in archives:
+        members = [{"arcname": arcname, "sha256": stored[file_path][0], "size": stored[file_path][1]}
+                   for file_path, arcname in files]
+        uploaded = sum(stored[file_path][2] for file_path, _ in files)
+        entries.append({"filename": filename, "members": members})
+        results.append(ManifestArchive(filename, members, uploaded))
+        print(f"Manifest entry '{filename}' ({len(members)} files, {uploaded / 1024:.1f} KB new) "
+              f"has been saved to MongoDB successfully.")
+    # Each run attempt has its own manifest (see get_run_id); an archive published again under the
+    # same run replaces its earlier entry instead of sitting next to it
+    manifest_query = {"collection": collection_name, "run_id": run_id}
+    manifests = zip_db[MANIFEST_COLLECTION]
+    manifests.update_one(
+        manifest_query,
+        {"$pull": {"archives": {"filename": {"$in": [entry["filename"] for entry in entries]}}},
+         "$setOnInsert": {"created_at": datetime.now(timezone.utc), "complete": False}},
+        upsert=True)
+    manifests.update_one(manifest_query, {"$push": {"archives": {"$each": entries}}})
+    return results
+
+# Function to mark a run's manifest as the published one, drop older manifests and collect unused blobs
+def finish_manifest(zip_db, collection_name, run_id):
+    manifests = zip_db[MANIFEST_COLLECTION]
+    manifests.update_one({"collection": collection_name, "run_id": run_id}, {"$set": {"complete": True}})
+    deleted = manifests.delete_many({"collection": collection_name, "run_id": {"$ne": run_id}}).deleted_count
+    print(f"Deleted {deleted} old manifest(s) of '{collection_name}'.")
+    collect_unreferenced_blobs(zip_db)
+
+# Function to delete blobs that no manifest refers to any more
+def collect_unreferenced_blobs(zip_db):
+    referenced = set(zip_db[MANIFEST_COLLECTION].distinct("archives.members.sha256"))
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=blob_gc_grace_seconds)
+    bucket = get_blob_bucket(zip_db)
+    deleted = 0
+    for blob in zip_db[f"{BLOB_BUCKET}.files"].find({"uploadDate": {"$lt": cutoff}}, projection={"filename": 1}):
+        if blob["filename"] not in referenced:
+            bucket.delete(blob["_id"])
+            deleted += 1
+    print(f"Deleted {deleted} unreferenced blob(s).")
+    return deleted
+
+# Function to get the latest published manifest of a collection (or the one of a given run)
+def get_manifest(zip_db, collection_name, run_id=None):
+    query = {"collection": collection_name}
+    query.update({"complete": True} if run_id is None else {"run_id": run_id})
+    manifest = zip_db[MANIFEST_COLLECTION].find_one(query, sort=[("created_at", -1)])
+    if manifest is None:
+        raise FileNotFoundError(f"No manifest found for '{collection_name}'.")
+    return manifest
+
+# Function to rebuild one archive of a delta-published collection as a zip written to output_stream,
+# streaming every member from its blob. Members are stored or deflated like upload_files_as_zip.
+def rebuild_archive(zip_db, collection_name, filename, output_stream, run_id=None):
+    manifest = get_manifest(zip_db, collection_name, run_id)
+    # The latest entry wins, should a filename ever appear twice
+    archive = next((archive for archive in reversed(manifest["archives"]) if archive["filename"] == filename), None)
+    if archive is None:
+        raise FileNotFoundError(f"Archive '{filename}' not found in the manifest of '{collection_name}'.")
+    bucket = get_blob_bucket(zip_db)
+    date_time = manifest["created_at"].timetuple()[:6]
+    with zipfile.ZipFile(output_stream, 'w', zipfile.ZIP_DEFLATED, compresslevel=archive_deflate_level) as zipf:
+        for member in archive["members"]:
+            member_info = zipfile.ZipInfo(member["arcname"], date_time=date_time)
+            member_info.compress_type = get_compress_type(member["arcname"])
+            member_info.file_size = member["size"]
+            with zipf.open(member_info, 'w') as entry:
+                bucket.download_to_stream_by_name(member["sha256"], entry)
+    return archive
+
+# Function to open the latest archive with the given name as a seekable, lazily-read stream.
+# The result can be passed straight to zipfile.ZipFile to read single members.
+def open_archive(zip_db, collection_name, filename):
+    record = zip_db[collection_name].find_one({"filename": filename}, sort=[("uploaded_at", -1)])
+    if record is None:
+        raise FileNotFoundError(f"Archive '{filename}' not found in '{collection_name}'.")
+    if "gridfs_id" not in record:
+        # Archive stored inline by an older run
+        return io.BytesIO(record["filedata"])
+    return get_archive_bucket(zip_db, collection_name).open_download_stream(record["gridfs_id"])
+
+# Function to stream an archive into a writable file object chunk by chunk, verifying its checksum
+def download_archive(zip_db, collection_name, filename, output_stream, chunk_size=1024 * 1024):
+    record = zip_db[collection_name].find_one({"filename": filename}, sort=[("uploaded_at", -1)])
+    sha256 = hashlib.sha256()
+    with open_archive(zip_db, collection_name, filename) as archive:
+        for chunk in iter(lambda: archive.read(chunk_size), b""):
+            output_stream.write(chunk)
+            sha256.update(chunk)
+    if record.get("sha256") and record["sha256"] != sha256.hexdigest():
+        raise ValueError(f"Checksum mismatch for archive '{filename}'.")
+    return record
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+
+from gridfs import GridFSBucket
+
+# Per-collection artifact cache. A collection's fingerprint (document count plus highest _id, the
+# collection UUID, plus a variant string describing the output settings) is cheap to get from the
+# _id index and the catalog;
+# when it matches the fingerprint recorded for the last generated .xlsx/.png/.json, that
+# artifact is reused instead of being fetched and regenerated.
+#
+# artifact_cache=mongo keeps fingerprints and artifact bytes in the artifact_cache database
+# (works on ephemeral CI runners), artifact_cache=disk keeps them under artifact_cache_dir,
+# and artifact_cache=off (the default) disables caching.
+artifact_cache_mode = os.getenv("artifact_cache", "off")
+artifact_cache_dir = os.getenv("artifact_cache_dir", ".artifact_cache")
+artifact_cache_db_name = "artifact_cache"
+
+# Function to get the UUID of a collection. Every full rebuild (swapped or dropped) creates new
+# collections, so it changes even when the rebuilt documents keep the same count and _ids.
+def get_collection_uuid(db, collection_name):
+    info = next(db.list_collections(filter={"name": collection_name}), {}).get("info", {})
+    return info["uuid"].hex() if "uuid" in info else None
+
+# Function to compute the cheap fingerprint of a collection
+def get_collection_fingerprint(db, collection_name, variant=""):
+    collection = db[collection_name]
+    last_document = collection.find_one({}, projection={"_id": 1}, sort=[("_id", -1)])
+    return {
+        "count": collection.estimated_document_count(),
+        "max_id": None if last_document is None else str(last_document["_id"]),
+        "uuid": get_collection_uuid(db, collection_name),
+        "variant": variant
+    }
+
+# Function to hash a file without reading it into memory at once
+def hash_file(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Function to delete every file under a directory that was not produced by this run,
+# so output folders can be kept between runs instead of being wiped
+def prune_directory(directory, keep_paths):
+    keep_paths = {os.path.abspath(path) for path in keep_paths}
+    removed = 0
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            file_path = os.path.abspath(os.path.join(root, file))
+            if file_path not in keep_paths:
+                os.remove(file_path)
+                removed += 1
+    if removed:
+        print(f"Removed {removed} stale file(s) from '{directory}'.")
+    return removed
+
+# Base cache: hit/miss bookkeeping and the restore/store protocol shared by both backends
+class ArtifactCache:
+    def __init__(self, kind):
+        self.kind = kind
+        self.hits = []
+        self.misses = []
+
+    # Function to copy the cached artifact to output_path when the fingerprint matches.
+    # Returns True on a hit; an up-to-date file already at output_path is not copied again.
+    def restore(self, collection_name, fingerprint, output_path):
+        entry = self._get_entry(collection_name)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            self.misses.append(collection_name)
+            return False
+        if not (os.path.exists(output_path) and os.path.getsize(output_path) == entry["size"]
+                and hash_file(output_path) == entry["sha256"]):
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            self._read_artifact(entry, output_path)
+        self.hits.append(collection_name)
+        return True
+
+    # Function to tell, without copying anything, whether restore() would hit
+    def is_fresh(self, collection_name, fingerprint):
+        entry = self._get_entry(collection_name)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    # Function to count a miss found through is_fresh, where restore() is never called
+    def record_miss(self, collection_name):
+        self.misses.append(collection_name)
+
+    # Function to record a freshly generated artifact under the collection's fingerprint
+    def store(self, collection_name, fingerprint, output_path):
+        entry = {
+            "kind": self.kind,
+            "collection": collection_name,
+            "fingerprint": fingerprint,
+            "size": os.path.getsize(output_path),
+            "sha256": hash_file(output_path),
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }
+        self._write_artifact(collection_name, entry, output_path)
+
+    def report(self):
+        total = len(self.hits) + len(self.misses)
+        print(f"[{self.kind}] artifact cache: {len(self.hits)} hit(s), {len(self.misses)} miss(es) out of {total}.")
+        return {"kind": self.kind, "hits": len(self.hits), "misses": len(self.misses)}
+
+    def close(self):
+        self.report()
+
+# Cache with fingerprints in artifact_cache.fingerprints and artifact bytes in GridFS
+class MongoArtifactCache(ArtifactCache):
+    def __init__(self, kind, client):
+        super().__init__(kind)
+        cache_db = client[artifact_cache_db_name]
+        self.entries = cache_db['fingerprints']
+        self.bucket = GridFSBucket(cache_db, bucket_name="artifacts")
+
+    def _get_entry(self, collection_name):
+        return self.entries.find_one({"_id": f"{self.kind}/{collection_name}"})
+
+    def _read_artifact(self, entry, output_path):
+        with open(output_path, 'wb') as f:
+            self.bucket.download_to_stream(entry["gridfs_id"], f)
+
+    def _write_artifact(self, collection_name, entry, output_path):
+        previous = self._get_entry(collection_name)
+        with open(output_path, 'rb') as f:
+            entry["gridfs_id"] = self.bucket.upload_from_stream(f"{self.kind}/{collection_name}", f)
+        self.entries.replace_one({"_id": f"{self.kind}/{collection_name}"}, entry, upsert=True)
+        if previous is not None:
+            self.bucket.delete(previous["gridfs_id"])
+
+# Cache with fingerprints in <artifact_cache_dir>/<kind>/index.json and artifacts next to it
+class DiskArtifactCache(ArtifactCache):
+    def __init__(self, kind, cache_dir):
+        super().__init__(kind)
+        self.directory = os.path.join(cache_dir, kind)
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def _get_entry(self, collection_name):
+        return self.index.get(collection_name)
+
+    def _read_artifact(self, entry, output_path):
+        shutil.copyfile(os.path.join(self.directory, entry["file"]), output_path)
+
+    def _write_artifact(self, collection_name, entry, output_path):
+        entry["file"] = entry["sha256"] + os.path.splitext(output_path)[1]
+        cached_path = os.path.join(self.directory, entry["file"])
+        if not os.path.exists(cached_path):
+            shutil.copyfile(output_path, cached_path)
+        previous = self.index.get(collection_name)
+        self.index[collection_name] = entry
+        if previous is not None and previous["file"] != entry["file"] \
+                and all(other["file"] != previous["file"] for other in self.index.values()):
+            os.remove(os.path.join(self.directory, previous["file"]))
+
+    def close(self):
+        with open(self.index_path, 'w') as f:
+            json.dump(self.index, f, indent=4)
+        super().close()
+
+# Function to open the configured artifact cache for one kind of artifact, or None when disabled
+def open_artifact_cache(kind, client=None, mode=None):
+    mode = mode or artifact_cache_mode
+    if mode == "mongo":
+        return MongoArtifactCache(kind, client)
+    if mode == "disk":
+        return DiskArtifactCache(kind, artifact_cache_dir)
+    return None
@@ -0,0 +1,238 @@
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import pymongo
+
+from timestamp_utils import TIMESTAMP_FORMAT
+
+# Benchmark suite: fills a local MongoDB with synthetic asinc_profits history, runs each pipeline
+# stage against it as its own process (same scripts, same settings as CI) and reports wall time,
+# throughput and peak memory per stage from the stages' run reports. Compare against a previous
+# benchmark_report.json with benchmark_baseline to catch regressions before deploying.
+#
+#     benchmark_mongo_url=mongodb://localhost:27017 benchmark_machines=200 benchmark_hours=720 python benchmark.py
+#
+# Without benchmark_mongo_url a throwaway mongod is started with pymongo_inmemory, if installed.
+# The benchmark drops the pipeline's databases, so it refuses non-local servers unless
+# benchmark_allow_remote=1.
+
+benchmark_mongo_url = os.getenv("benchmark_mongo_url")
+benchmark_allow_remote = os.getenv("benchmark_allow_remote", "0") == "1"
+benchmark_machines = int(os.getenv("benchmark_machines", "50"))
+# Hours of history per machine (720 = 30 days)
+benchmark_hours = int(os.getenv("benchmark_hours", "720"))
+benchmark_seed = int(os.getenv("benchmark_seed", "42"))
+# Comma-separated stages to run, in order; can also be given as arguments
+benchmark_stages = os.getenv("benchmark_stages", "load_json,load_json_file,load_excel_file,load_img_files")
+benchmark_report_path = os.getenv("benchmark_report_path", "benchmark_report.json")
+# Previous benchmark_report.json to compare with, and the slowdown/memory growth tolerated (0.2 = 20%)
+benchmark_baseline = os.getenv("benchmark_baseline")
+benchmark_tolerance = float(os.getenv("benchmark_tolerance", "0.2"))
+
+# Stages that can be benchmarked; each is run as `python <script>`
+stage_scripts = {
+    "load_json": "load_json.py",
+    "load_json_file": "load_json_file.py",
+    "load_parquet_file": "load_parquet_file.py",
+    "load_excel_file": "load_excel_file.py",
+    "load_img_files": "load_img_files.py",
+    "export_pipeline": "export_pipeline.py",
+    # Compares transform_engine=aggregation with format_documents in its own scratch database
+    "aggregation_check": "check_aggregation_engine.py",
+}
+
+# Databases the pipeline reads and writes; dropped before every benchmark
+pipeline_databases = ["mydatabase", "channel_related_json", "channel_rollups", "zip_files", "sync_state",
+                      "artifact_cache"]
+
+machine_models = [
+    ("Antminer S19 Pro", "110 Th/s", "SHA-256", 3250, "75db"),
+    ("Antminer S21", "200 Th/s", "SHA-256", 3500, "75db"),
+    ("Whatsminer M50S", "126 Th/s", "SHA-256", 3276, "75db"),
+    ("Antminer L7", "9.5 Gh/s", "Scrypt", 3425, "75db"),
+    ("Antminer KS3", "9.4 Th/s", "KHeavyHash", 3500, "80db"),
+    ("Goldshell AL Box", "360 Gh/s", "Blake2S", 180, "10db"),
+]
+model_release_dates = ["Nov 2020", "Jun 2021", "Sep 2022", "Jan 2023", "Oct 2023", "Feb 2024"]
+
+# Function to format a daily profit the way the source site does, e.g. "$1,234.56/day" or "-$3.10/day"
+def format_rentability(profit):
+    sign = "-" if profit < 0 else ""
+    return f"{sign}${abs(profit):,.2f}/day"
+
+# Function to generate realistic asinc_profits documents: one per machine per hour, hour by hour,
+# with drifting profits, occasional negative days and a few "unknown" values
+def generate_source_documents(machine_count, hours, seed=42, start=datetime(2024, 1, 1)):
+    rng = random.Random(seed)
+    machines = []
+    for index in range(machine_count):
+        model, hash_rate, algorithm, watts, noise = machine_models[index % len(machine_models)]
+        machines.append({
+            "name": f"{model} #{index + 1}",
+            "date": rng.choice(model_release_dates),
+            "hash_rate": hash_rate,
+            "algorithm": algorithm,
+            "power_consumption": f"{watts + rng.randrange(-200, 201, 25)}W",
+            "noise_level": noise,
+            "profit": rng.uniform(-5, 2500),
+        })
+    for hour in range(hours):
+        timestamp = (start + timedelta(hours=hour)).strftime(TIMESTAMP_FORMAT)
+        for machine in machines:
+            machine["profit"] = machine["profit"] * rng.uniform(0.97, 1.03) + rng.uniform(-1, 1)
+            rentability = "unknown" if rng.random() < 0.02 else format_rentability(machine["profit"])
+            yield {
+                "name": machine["name"],
+                "rentability": rentability,
+                "power_consumption": machine["power_consumption"],
+                "updated_timestamp": timestamp,
+                "date": machine["date"],
+                "hash_rate": machine["hash_rate"],
+                "noise_level": machine["noise_level"],
+                "algorithm": machine["algorithm"],
+            }
+
+# Function to refuse dropping databases on anything but a local server
+def check_benchmark_server(mongo_url):
+    host = urlparse(mongo_url).hostname or ""
+    if host not in ("localhost", "127.0.0.1", "::1") and not benchmark_allow_remote:
+        print(f"Refusing to benchmark against '{host}': the benchmark drops {', '.join(pipeline_databases)}. "
+              f"Set benchmark_allow_remote=1 to override.")
+        sys.exit(1)
+
+# Function to drop the pipeline databases and load a fresh synthetic source collection
+def seed_benchmark_data(client, machine_count, hours, seed, batch_size=10000):
+    for db_name in pipeline_databases:
+        client.drop_database(db_name)
+    source = client["mydatabase"]["asinc_profits"]
+    batch = []
+    total = 0
+    for doc in generate_source_documents(machine_count, hours, seed):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            source.insert_many(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        source.insert_many(batch)
+        total += len(batch)
+    print(f"Generated {total} source documents for {machine_count} machines over {hours} hours.")
+    return total
+
+# Function to run one stage as its own process and collect its timings from its run report
+def run_stage(stage, mongo_url, work_dir, report_dir, document_count):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), stage_scripts[stage])
+    env = dict(os.environ, load_mongo_url=mongo_url, target_mongo_url=mongo_url, run_report_dir=report_dir,
+               store_run_report="0")
+    print(f"\n=== {stage} ===")
+    start_time = time.perf_counter()
+    completed = subprocess.run([sys.executable, script], cwd=work_dir, env=env)
+    wall_seconds = time.perf_counter() - start_time
+
+    result = {
+        "stage": stage,
+        "status": "ok" if completed.returncode == 0 else "failed",
+        "wall_seconds": round(wall_seconds, 3),
+        "documents": document_count,
+        "documents_per_second": round(document_count / wall_seconds, 1) if wall_seconds > 0 else None,
+    }
+    report_path = os.path.join(report_dir, f"{stage}_report.json")
+    if os.path.exists(report_path):
+        with open(report_path) as f:
+            run_report = json.load(f)
+        peak_rss = run_report["peak_rss_mb"]
+        result["peak_rss_mb"] = max(peak_rss["self"], peak_rss["children"])
+        result["stages"] = {name: measurement["seconds"] for name, measurement in run_report["stages"].items()}
+    return result
+
+# Function to compare results with a previous benchmark report; returns the regressions found
+def compare_with_baseline(results, baseline, tolerance):
+    previous = {result["stage"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["stage"])
+        if before is None or result["status"] != "ok":
+            continue
+        for metric in ("wall_seconds", "peak_rss_mb"):
+            if before.get(metric) and result.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{result['stage']} {metric}: {before[metric]} -> {result[metric]}")
+    return regressions
+
+# Function to start a throwaway mongod when no server is given
+def start_benchmark_server():
+    try:
+        from pymongo_inmemory import Mongod
+    except ImportError:
+        print("Set benchmark_mongo_url to a local MongoDB (or pip install pymongo_inmemory).")
+        sys.exit(1)
+    mongod = Mongod()
+    mongod.start()
+    return mongod, mongod.connection_string
+
+def main():
+    stages = sys.argv[1:] or [name.strip() for name in benchmark_stages.split(",") if name.strip()]
+    unknown = [stage for stage in stages if stage not in stage_scripts]
+    if unknown:
+        print(f"Unknown stage(s): {', '.join(unknown)}. Available: {', '.join(stage_scripts)}")
+        sys.exit(1)
+
+    mongod = None
+    mongo_url = benchmark_mongo_url
+    if mongo_url:
+        check_benchmark_server(mongo_url)
+    else:
+        mongod, mongo_url = start_benchmark_server()
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    report_dir = os.path.join(work_dir, "run_reports")
+    try:
+        client = pymongo.MongoClient(mongo_url)
+        document_count = seed_benchmark_data(client, benchmark_machines, benchmark_hours, benchmark_seed)
+        client.close()
+
+        results = [run_stage(stage, mongo_url, work_dir, report_dir, document_count) for stage in stages]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if mongod is not None:
+            mongod.stop()
+
+    print("\nStage                 Wall (s)   Docs/s      Peak RSS (MB)  Status")
+    for result in results:
+        print(f"{result['stage']:<21} {result['wall_seconds']:>8.2f}   {result['documents_per_second'] or 0:>9.0f}   "
+              f"{result.get('peak_rss_mb', 0):>12.1f}  {result['status']}")
+
+    # Read the baseline first: it may be the report file about to be overwritten
+    baseline = None
+    if benchmark_baseline:
+        with open(benchmark_baseline) as f:
+            baseline = json.load(f)
+
+    benchmark_report = {
+        "machines": benchmark_machines,
+        "hours": benchmark_hours,
+        "seed": benchmark_seed,
+        "documents": document_count,
+        "created_at": datetime.now().isoformat(),
+        "results": results
+    }
+    with open(benchmark_report_path, 'w') as f:
+        json.dump(benchmark_report, f, indent=4)
+    print(f"Benchmark report written to {benchmark_report_path}.")
+
+    failed = [result["stage"] for result in results if result["status"] != "ok"]
+    regressions = compare_with_baseline(results, baseline, benchmark_tolerance) if baseline else []
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if failed or regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+from run_report import get_run_report
+
+DUPLICATE_KEY_ERROR = 11000
+
+# Function to split a list of documents into fixed-size batches
+def split_batches(documents, batch_size):
+    return [documents[start:start + batch_size] for start in range(0, len(documents), batch_size)]
+
+# Function to insert one batch unordered, retrying transient failures, timed per collection in the run report
+def insert_batch(collection, batch, max_retries=3, retry_delay=1.0):
+    with get_run_report().span("upload", collection.name) as span:
+        span["documents"] = len(batch)
+        return insert_batch_with_retries(collection, batch, max_retries, retry_delay)
+
+# insert_many sets _id on the documents before sending them, so a retried batch reuses the same
+# _ids: documents that already made it in come back as duplicate-key errors and count as written.
+def insert_batch_with_retries(collection, batch, max_retries, retry_delay):
+    attempt = 0
+    while True:
+        try:
+            collection.insert_many(batch, ordered=False)
+            return len(batch)
+        except BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            if write_errors and all(error["code"] == DUPLICATE_KEY_ERROR for error in write_errors) \
+                    and not e.details.get("writeConcernErrors"):
+                return len(batch)
+            if attempt >= max_retries:
+                raise
+        except ConnectionFailure:
+            if attempt >= max_retries:
+                raise
+        attempt += 1
+        get_run_report().count("insert_retries")
+        print(f"Retrying batch of {len(batch)} documents for {collection.name} (attempt {attempt}/{max_retries})")
+        time.sleep(retry_delay * attempt)
+
+# Function to write many collections at once: every collection's documents are cut into
+# fixed-size batches and all batches are inserted concurrently through a thread pool sized to
+# the client's connection pool (or `workers`). Returns a summary with documents per second.
+def write_collections(db, collections_data, batch_size=1000, workers=None, max_retries=3):
+    workers = workers or db.client.options.pool_options.max_pool_size
+    tasks = [(name, batch) for name, documents in collections_data.items()
+             for batch in split_batches(documents, batch_size)]
+    written = {name: 0 for name in collections_data}
+    failed = {}
+
+    start_time = time.time()
+    if tasks:
+        with ThreadPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+            futures = {executor.submit(insert_batch, db[name], batch, max_retries): name for name, batch in tasks}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    written[name] += future.result()
+                except Exception as e:
+                    failed[name] = str(e)
+    elapsed = time.time() - start_time
+
+    total_collections = len(collections_data)
+    for index, name in enumerate(collections_data, start=1):
+        status = f" (failed: {failed[name]})" if name in failed else ""
+        print(f"Inserted {written[name]} documents into collection {name} ({index}/{total_collections}){status}")
+
+    total_documents = sum(written.values())
+    documents_per_second = total_documents / elapsed if elapsed > 0 else float(total_documents)
+    print(f"Wrote {total_documents} documents in {len(tasks)} batches across {total_collections} collections "
+          f"in {elapsed:.2f} seconds ({documents_per_second:.0f} documents/second, {min(workers, max(len(tasks), 1))} threads).")
+    return {
+        "documents": total_documents,
+        "batches": len(tasks),
+        "collections": total_collections,
+        "seconds": elapsed,
+        "documents_per_second": documents_per_second,
+        "failed": failed
+    }
@@ -0,0 +1,105 @@
+import os
+import sys
+
+import pymongo
+from pymongo.errors import ServerSelectionTimeoutError
+
+import load_json
+from benchmark import generate_source_documents
+from mongo_reader import find_documents
+
+# Checks that transform_engine=aggregation writes exactly what format_documents produces: the same
+# fields in the same order with the same values, both when the formatted documents are streamed
+# back and inserted and when $merge writes them on the server, and that running the $merge again
+# (a replayed run) leaves the collections unchanged. Runs against a local mongod and only touches
+# its own scratch database; without a reachable server it is skipped.
+#
+#     check_mongo_url=mongodb://localhost:27017 python check_aggregation_engine.py
+#
+# Also available as the aggregation_check stage of benchmark.py.
+
+check_mongo_url = os.getenv("check_mongo_url") or os.getenv("target_mongo_url") or "mongodb://localhost:27017"
+check_db_name = "aggregation_engine_check"
+check_machines = int(os.getenv("check_machines", "6"))
+check_hours = int(os.getenv("check_hours", "48"))
+
+# Source values the synthetic generator does not produce but the transform has to handle
+edge_case_documents = [
+    {"rentability": "Unknown", "hash_rate": "100 Th/s", "noise_level": "75db"},
+    {"rentability": " $1,234.56/day ", "hash_rate": 5, "noise_level": None},
+    {"rentability": "-$0.07/day", "hash_rate": None, "noise_level": "75db"},
+    {"rentability": "$0.00/day", "hash_rate": 5.5, "noise_level": ""},
+    {"rentability": "-$12,345,678.91/day", "hash_rate": "9.4 Th/s", "noise_level": "80db"},
+]
+
+# Function to build the source documents of the check: synthetic history plus the edge cases
+def build_check_documents():
+    documents = list(generate_source_documents(check_machines, check_hours))
+    for index, edge_case in enumerate(edge_case_documents):
+        documents.append({
+            "name": "Edge case",
+            "power_consumption": f"{3000 + index * 7}W",
+            "updated_timestamp": "Monday, Jan 01, 2024, 03 PM",
+            "date": "Jan 2024",
+            "algorithm": "SHA-256",
+            **edge_case,
+        })
+    return documents
+
+# Function to compare the collections written under prefix with the expected formatted documents.
+# Returns a description of every difference.
+def compare_collections(db, prefix, expected):
+    differences = []
+    written = {name[len(prefix):] for name in db.list_collection_names() if name.startswith(prefix)}
+    for machine_name in sorted(written ^ set(expected)):
+        differences.append(f"{prefix}{machine_name}: collection {'missing' if machine_name in expected else 'unexpected'}")
+    for machine_name in sorted(written & set(expected)):
+        actual = list(db[prefix + machine_name].find(sort=[("_id", 1)]))
+        wanted = sorted(expected[machine_name], key=lambda document: document["_id"])
+        if len(actual) != len(wanted):
+            differences.append(f"{prefix}{machine_name}: {len(actual)} documents, expected {len(wanted)}")
+            continue
+        for actual_document, wanted_document in zip(actual, wanted):
+            # Field order matters too: the exports write the fields as stored
+            if list(actual_document.items()) != list(wanted_document.items()):
+                differences.append(f"{prefix}{machine_name} {wanted_document['_id']}: "
+                                   f"{list(actual_document.items())} != {list(wanted_document.items())}")
+                break
+    return differences
+
+def main():
+    client = pymongo.MongoClient(check_mongo_url, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except ServerSelectionTimeoutError:
+        print(f"No MongoDB server at {check_mongo_url}; skipping the aggregation engine check.")
+        return
+
+    db = client[check_db_name]
+    try:
+        client.drop_database(check_db_name)
+        db["source"].insert_many(build_check_documents())
+        # Same read and decoding as load_json.py
+        source_documents = list(find_documents(db, "source", "source", sort=[("_id", 1)]))
+        expected = load_json.format_documents(source_documents)
+
+        load_json.sync_with_aggregation(db["source"], db, {}, merge_on_server=False, collection_prefix="streamed.")
+        load_json.sync_with_aggregation(db["source"], db, {}, merge_on_server=True, collection_prefix="merged.")
+        differences = compare_collections(db, "streamed.", expected) + compare_collections(db, "merged.", expected)
+
+        # A replayed $merge (keepExisting) must neither fail nor add or change documents
+        load_json.sync_with_aggregation(db["source"], db, {}, merge_on_server=True, collection_prefix="merged.")
+        differences += [f"after replay: {difference}" for difference in compare_collections(db, "merged.", expected)]
+    finally:
+        client.drop_database(check_db_name)
+        client.close()
+
+    for difference in differences:
+        print(f"Mismatch: {difference}")
+    if differences:
+        print(f"The aggregation engine differs from format_documents ({len(differences)} mismatch(es)).")
+        sys.exit(1)
+    print(f"The aggregation engine matches format_documents for {len(source_documents)} documents.")
+
+if __name__ == "__main__":
+    main()
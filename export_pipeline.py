@@ -0,0 +1,601 @@
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import wait
+
+import pymongo
+
+from archive_store import GridFSArchiveSink, archive_deflate_level, pack_files_by_size, upload_archives, delete_old_archives, get_run_id
+from artifact_cache import open_artifact_cache, get_collection_fingerprint, prune_directory
+from mongo_reader import find_documents, list_machine_collections
+from process_pool import create_process_pool
+from run_report import start_run_report, get_run_report
+import load_json_file
+
+# Single-scan export: every collection of channel_related_json is read once and the decoded
+# documents are handed to each selected sink (JSON, Excel, chart, ...), instead of
+# load_json_file.py, load_excel_file.py and load_img_files.py each reading everything again.
+
+target_mongo_url = os.getenv("target_mongo_url")
+target_db_name = "channel_related_json"
+
+# Comma-separated sink names to run; can also be given as arguments, e.g. `python export_pipeline.py json img`
+export_sinks = os.getenv("export_sinks", "json,excel,img")
+
+# pipeline_mode=sync reads, encodes and uploads one step after the other; pipeline_mode=async overlaps
+# them: collections are fetched with the async client while earlier ones are encoded and finished
+# folders are uploaded. Same archives either way.
+pipeline_mode = os.getenv("pipeline_mode", "sync")
+# Collections buffered between the async stages; bounds the documents held in memory
+async_queue_size = int(os.getenv("async_queue_size", "4"))
+
+# Base class for export sinks. A sink receives every collection's decoded documents in
+# collection order through add() and publishes its archive(s) in close().
+# The documents list is shared between sinks, so sinks must not modify it.
+# Sinks with an artifact cache first get a chance to restore() an unchanged collection;
+# a collection is only read when at least one sink misses.
+class ExportSink:
+    name = None
+    # mongo_reader consumer whose projection and decoding the sink needs; None when it reads no documents
+    consumer = "json"
+    cache_variant = ""
+    # Work items a sink may have queued in its process pool at once; None when it has no pool
+    max_in_flight = None
+
+    def open(self, zip_db, run_id):
+        self.zip_db = zip_db
+        self.run_id = run_id
+        self.cache = open_artifact_cache(self.name, zip_db.client)
+
+    # Function to get the sink's own fingerprint from the collection's base fingerprint
+    def get_fingerprint(self, fingerprint):
+        return dict(fingerprint, variant=self.cache_variant)
+
+    def restore(self, collection_index, collection_name, fingerprint):
+        return False
+
+    # Function to tell, without side effects, whether restore() will hit for this collection
+    def is_restorable(self, collection_name, fingerprint):
+        return self.cache is not None and self.cache.is_fresh(collection_name, self.get_fingerprint(fingerprint))
+
+    def add(self, collection_index, collection_name, documents, fingerprint=None):
+        raise NotImplementedError
+
+    # Function to hand out the parts of the output that are complete and can be uploaded early
+    def take_completed_folders(self):
+        return []
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+    def abort(self):
+        pass
+
+# JSON sink: one json_files.zip streamed straight into GridFS, same layout as load_json_file.py
+class JsonSink(ExportSink):
+    name = "json"
+    consumer = "json"
+
+    def open(self, zip_db, run_id):
+        super().open(zip_db, run_id)
+        self.cache_variant = load_json_file.json_cache_variant
+        self._staging_dir = tempfile.mkdtemp()
+        self._upload = GridFSArchiveSink(zip_db, 'json_files', 'json_files.zip', run_id)
+        self._zipf = zipfile.ZipFile(self._upload, 'w', zipfile.ZIP_DEFLATED, compresslevel=archive_deflate_level)
+
+    def get_arcname(self, collection_name):
+        return f'{load_json_file.sanitize_collection_name(collection_name)}.json'
+
+    def restore(self, collection_index, collection_name, fingerprint):
+        if self.cache is None:
+            return False
+        return load_json_file.restore_cached_json(self._zipf, self.get_arcname(collection_name), collection_name,
+                                                  self.get_fingerprint(fingerprint), self.cache, self._staging_dir)
+
+    def add(self, collection_index, collection_name, documents, fingerprint=None):
+        arcname = self.get_arcname(collection_name)
+        if self.cache is None:
+            load_json_file.write_documents_to_zip(self._zipf, arcname, documents, indent=load_json_file.json_indent)
+        else:
+            load_json_file.write_documents_to_zip_and_cache(self._zipf, arcname, documents, collection_name,
+                                                            self.get_fingerprint(fingerprint), self.cache,
+                                                            self._staging_dir)
+
+    def close(self):
+        self._zipf.close()
+        self._upload.close()
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+        delete_old_archives(self.zip_db, 'json_files', keep_run_id=self.run_id)
+        super().close()
+
+    def abort(self):
+        self._upload.abort()
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+
+# Columnar sink: one parquet_files.zip of typed Parquet/Arrow tables, same layout as load_parquet_file.py
+class ColumnarSink(ExportSink):
+    name = "parquet"
+    consumer = "parquet"
+
+    def open(self, zip_db, run_id):
+        import load_parquet_file
+        self._columnar = load_parquet_file
+        super().open(zip_db, run_id)
+        self.cache_variant = load_parquet_file.columnar_cache_variant
+        self._staging_dir = tempfile.mkdtemp()
+        self._upload = GridFSArchiveSink(zip_db, 'parquet_files', 'parquet_files.zip', run_id)
+        self._zipf = zipfile.ZipFile(self._upload, 'w', zipfile.ZIP_STORED)
+
+    def restore(self, collection_index, collection_name, fingerprint):
+        if self.cache is None:
+            return False
+        return self._columnar.restore_cached_table(self._zipf, self._columnar.get_columnar_arcname(collection_name),
+                                                   collection_name, self.get_fingerprint(fingerprint), self.cache,
+                                                   self._staging_dir)
+
+    def add(self, collection_index, collection_name, documents, fingerprint=None):
+        self._columnar.write_documents_to_columnar_zip(
+            self._zipf, self._columnar.get_columnar_arcname(collection_name), documents, self._staging_dir,
+            collection_name, None if self.cache is None else self.get_fingerprint(fingerprint), self.cache)
+
+    def close(self):
+        self._zipf.close()
+        self._upload.close()
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+        delete_old_archives(self.zip_db, 'parquet_files', keep_run_id=self.run_id)
+        super().close()
+
+    def abort(self):
+        self._upload.abort()
+        shutil.rmtree(self._staging_dir, ignore_errors=True)
+
+# Shared behaviour of the sinks that write one file per collection into folder_N directories and
+# upload the files, in collection order, as size-bounded archives. Collections arrive in order, so a
+# folder is complete as soon as the next one starts; its files are then packed, and every archive
+# that reached the size budget is uploaded while later collections are still encoded.
+class FolderArchiveSink(ExportSink):
+    base_directory = None
+    collection_name = None
+    collections_per_folder = None
+    clear_base_directory = False
+    # Worker processes; with more than one, submit() sends the work to a pool
+    workers = 1
+    # Work items handed to the pool but not finished yet, per worker. Each holds its arguments
+    # (a whole DataFrame or chart arrays) in this process, so submit() waits for the oldest
+    # one before going over the limit.
+    max_in_flight_per_worker = 2
+
+    def open(self, zip_db, run_id):
+        super().open(zip_db, run_id)
+        # With an artifact cache the folders are kept between runs and only stale files are pruned
+        if self.clear_base_directory and self.cache is None and os.path.exists(self.base_directory):
+            shutil.rmtree(self.base_directory)
+        self.folder_names = []
+        self.results = []
+        self._folders = {}
+        self._order = {}
+        self._fingerprints = {}
+        self._pending = {}
+        self._completed_folders = set()
+        self._finished_folders = set()
+        self._unarchived = []
+        self._archive_count = 0
+        self._in_flight = deque()
+        self.max_in_flight = self.max_in_flight_per_worker * self.workers
+        # The async pipeline uploads finished folders while the next collections are being added
+        self._lock = threading.Lock()
+        self._pool = self.create_pool()
+
+    def create_pool(self):
+        return None
+
+    def get_output_path(self, folder_path, collection_name):
+        raise NotImplementedError
+
+    # Function to get (and create) the folder a collection belongs to, same batching as the scripts
+    def get_folder_path(self, collection_index, collection_name):
+        folder_name = f"folder_{collection_index // self.collections_per_folder + 1}"
+        folder_path = os.path.join(self.base_directory, folder_name)
+        with self._lock:
+            if folder_name not in self.folder_names:
+                self.folder_names.append(folder_name)
+                os.makedirs(folder_path, exist_ok=True)
+            self._folders[collection_name] = folder_name
+            self._order[collection_name] = collection_index
+        return folder_path
+
+    def restore(self, collection_index, collection_name, fingerprint):
+        if self.cache is None:
+            return False
+        output_path = self.get_output_path(self.get_folder_path(collection_index, collection_name), collection_name)
+        if not self.cache.restore(collection_name, self.get_fingerprint(fingerprint), output_path):
+            return False
+        self.record_result({"collection": collection_name, "file": output_path, "status": "ok", "cached": True})
+        return True
+
+    def record_result(self, result):
+        with self._lock:
+            self.results.append(result)
+
+    # Function to run a task for a collection in the pool, or right here when there is no pool or in_process is set
+    def submit(self, task, collection_name, fingerprint, *args, in_process=False):
+        if fingerprint is not None:
+            self._fingerprints[collection_name] = self.get_fingerprint(fingerprint)
+        if self._pool is None or in_process:
+            self.record_result(task(collection_name, *args))
+        else:
+            self.wait_for_capacity()
+            future = self._pool.submit(task, collection_name, *args)
+            self._in_flight.append(future)
+            with self._lock:
+                self._pending[collection_name] = future
+
+    # Function to block until fewer than max_in_flight work items are running or queued in the pool.
+    # Finished futures stay in _pending until their folder collects the results.
+    def wait_for_capacity(self):
+        while self._in_flight and self._in_flight[0].done():
+            self._in_flight.popleft()
+        while len(self._in_flight) >= self.max_in_flight:
+            wait([self._in_flight.popleft()])
+
+    def take_completed_folders(self):
+        with self._lock:
+            completed = [folder_name for folder_name in self.folder_names[:-1] if folder_name not in self._completed_folders]
+            self._completed_folders.update(completed)
+        return completed
+
+    # Function to wait for a folder's files, cache them and queue them for the archives
+    def finish_folder(self, folder_name):
+        with self._lock:
+            pending = [(collection_name, future) for collection_name, future in self._pending.items()
+                       if self._folders[collection_name] == folder_name]
+        for collection_name, future in pending:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"collection": collection_name, "status": "failed", "error": repr(e)}
+            self.record_result(result)
+            with self._lock:
+                del self._pending[collection_name]
+        with self._lock:
+            folder_results = [result for result in self.results if self._folders[result["collection"]] == folder_name]
+
+        # Writing may have happened in worker processes, so its timings come back in the results
+        report = get_run_report()
+        for result in folder_results:
+            if result.get("cached"):
+                report.count(f"{self.name}_cached_collections")
+            else:
+                report.add(f"{self.name}:write", result["collection"], seconds=result.get("seconds", 0.0),
+                           bytes=result.get("bytes", int(result.get("size_kb", 0) * 1024)),
+                           errors=int(result["status"] != "ok"))
+
+        folder_path = os.path.join(self.base_directory, folder_name)
+        if self.cache is not None:
+            for result in folder_results:
+                if result["status"] == "ok" and not result.get("cached") and result["collection"] in self._fingerprints:
+                    self.cache.store(result["collection"], self._fingerprints[result["collection"]], result["file"])
+            prune_directory(folder_path, [result["file"] for result in folder_results if result["status"] == "ok"])
+
+        folder_results.sort(key=lambda result: self._order[result["collection"]])
+        with self._lock:
+            self._unarchived.extend(result["file"] for result in folder_results if result["status"] == "ok")
+            self._finished_folders.add(folder_name)
+        self.upload_packed_archives()
+
+    # Function to upload the archives that reached the size budget, or every remaining one when final
+    def upload_packed_archives(self, final=False):
+        with self._lock:
+            groups = pack_files_by_size(self._unarchived)
+            if not final:
+                # The last archive can still take files from the next folder
+                groups = groups[:-1]
+            if not groups:
+                return
+            self._unarchived = self._unarchived[sum(len(group) for group in groups):]
+            first_number = self._archive_count + 1
+            self._archive_count += len(groups)
+        archives = [(f"folder_{number}.zip", [(file_path, os.path.basename(file_path)) for file_path in group])
+                    for number, group in enumerate(groups, start=first_number)]
+        upload_archives(self.zip_db, self.collection_name, archives, self.run_id)
+
+    def close(self):
+        for folder_name in self.folder_names:
+            if folder_name not in self._finished_folders:
+                self.finish_folder(folder_name)
+        self.upload_packed_archives(final=True)
+        if self._pool is not None:
+            self._pool.shutdown()
+
+        failed = [result for result in self.results if result["status"] != "ok"]
+        print(f"[{self.name}] {len(self.results) - len(failed)} files written, {len(failed)} failed.")
+
+        # Folders from earlier, larger runs are no longer uploaded; drop their leftover files too
+        if self.cache is not None:
+            prune_directory(self.base_directory, [result["file"] for result in self.results if result["status"] == "ok"])
+
+        delete_old_archives(self.zip_db, self.collection_name, keep_run_id=self.run_id)
+        super().close()
+
+    def abort(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+
+# Excel sink: one .xlsx per collection, same folders and formatting as load_excel_file.py
+class ExcelSink(FolderArchiveSink):
+    name = "excel"
+    consumer = "excel"
+    collection_name = 'excel_files'
+    clear_base_directory = True
+
+    def open(self, zip_db, run_id):
+        import load_excel_file
+        self._excel = load_excel_file
+        self.base_directory = load_excel_file.base_directory
+        self.collections_per_folder = load_excel_file.max_collections_per_folder
+        self.cache_variant = load_excel_file.excel_cache_variant
+        self.workers = load_excel_file.excel_workers
+        # Rollup and chunked workbooks read their rows themselves instead of the scanned documents
+        if load_excel_file.excel_source != "raw" or load_excel_file.chunk_memory_budget_mb:
+            self.consumer = None
+        super().open(zip_db, run_id)
+
+    def create_pool(self):
+        return create_process_pool(self.workers)
+
+    def get_output_path(self, folder_path, collection_name):
+        return self._excel.get_excel_file_path(folder_path, collection_name)
+
+    def add(self, collection_index, collection_name, documents, fingerprint=None):
+        excel_file_path = self.get_output_path(self.get_folder_path(collection_index, collection_name), collection_name)
+        db = self.zip_db.client[self._excel.target_db_name]
+        try:
+            chunked = self.consumer is None and self._excel.is_chunked_export(db, collection_name)
+        except Exception as e:
+            print(f"Failed to export collection {collection_name} due to {e}")
+            self.record_result({"collection": collection_name, "file": excel_file_path, "status": "failed", "error": str(e)})
+            return
+        if chunked:
+            # Streamed from the cursor into the workbook in this process; workers have no connection
+            self.submit(self._excel.write_collection_workbook_chunked, collection_name, fingerprint, db, excel_file_path,
+                        in_process=True)
+            return
+        try:
+            if self.consumer is None:
+                df = self._excel.build_collection_dataframe(db, collection_name)
+            else:
+                df = self._excel.documents_to_dataframe(documents)
+        except Exception as e:
+            print(f"Failed to export collection {collection_name} due to {e}")
+            self.record_result({"collection": collection_name, "file": excel_file_path, "status": "failed", "error": str(e)})
+            return
+        self.submit(self._excel.write_collection_workbook, collection_name, fingerprint, df, excel_file_path)
+
+# Chart sink: one compressed .png per collection, same folders and rendering as load_img_files.py
+class ChartSink(FolderArchiveSink):
+    name = "img"
+    consumer = "chart"
+    base_directory = "temp_img_files"
+    collection_name = 'img_files'
+
+    def open(self, zip_db, run_id):
+        import load_img_files
+        self._img = load_img_files
+        self.collections_per_folder = load_img_files.collections_per_folder
+        self.cache_variant = load_img_files.img_cache_variant
+        self.workers = load_img_files.img_workers
+        # Rollup and chunked charts read their data themselves instead of the scanned documents
+        if load_img_files.chart_source != "raw" or load_img_files.chunk_memory_budget_mb:
+            self.consumer = None
+        super().open(zip_db, run_id)
+
+    def create_pool(self):
+        return create_process_pool(self.workers, initializer=self._img.init_render_worker)
+
+    def get_output_path(self, folder_path, collection_name):
+        return self._img.get_chart_file_path(folder_path, collection_name)
+
+    def add(self, collection_index, collection_name, documents, fingerprint=None):
+        output_file = self.get_output_path(self.get_folder_path(collection_index, collection_name), collection_name)
+        try:
+            if self.consumer is None:
+                chart_arrays = self._img.load_chart_data(self.zip_db.client[self._img.target_db_name], collection_name)
+            else:
+                chart_arrays = self._img.chart_data_from_documents(documents)
+        except Exception as e:
+            print(f"Error processing collection {collection_name}: {e}")
+            self.record_result({"collection": collection_name, "file": output_file, "status": "failed", "error": str(e)})
+            return
+        self.submit(self._img.render_chart_task, collection_name, fingerprint, output_file, *chart_arrays)
+
+# Registered sinks by name; register_sink adds new formats without touching the scan
+sink_registry = {
+    JsonSink.name: JsonSink,
+    ColumnarSink.name: ColumnarSink,
+    ExcelSink.name: ExcelSink,
+    ChartSink.name: ChartSink,
+}
+
+# Function to register an additional export sink class under its name
+def register_sink(sink_class):
+    sink_registry[sink_class.name] = sink_class
+    return sink_class
+
+# Function to read every collection once and feed its documents to all sinks
+def run_pipeline(db, zip_db, sinks, run_id=None):
+    run_id = run_id or get_run_id()
+    report = get_run_report()
+    for sink in sinks:
+        sink.open(zip_db, run_id)
+    try:
+        use_cache = any(sink.cache is not None for sink in sinks)
+        collection_names = list_machine_collections(db)
+        total_collections = len(collection_names)
+        with report.span("scan") as scan_span:
+            for collection_index, collection_name in enumerate(collection_names):
+                fingerprint = get_collection_fingerprint(db, collection_name) if use_cache else None
+                missing_sinks = [sink for sink in sinks if not sink.restore(collection_index, collection_name, fingerprint)]
+                if not missing_sinks:
+                    report.count("cached_collections")
+                    print(f"Reused cached artifacts for {collection_name}. ({collection_index + 1} out of {total_collections})")
+                    continue
+
+                # One read per collection, projected to what the missing sinks need and shared by them
+                consumers = [sink.consumer for sink in missing_sinks if sink.consumer is not None]
+                documents = []
+                if consumers:
+                    with report.span("fetch", collection_name) as span:
+                        documents = list(find_documents(db, collection_name, consumers))
+                        span["documents"] = len(documents)
+                scan_span["documents"] += len(documents)
+                for sink in missing_sinks:
+                    with report.span(sink.name, collection_name) as span:
+                        sink.add(collection_index, collection_name, documents, fingerprint)
+                        span["documents"] = len(documents)
+                print(f"Exported {collection_name} ({len(documents)} documents) to {len(missing_sinks)} sink(s). "
+                      f"({collection_index + 1} out of {total_collections})")
+    except Exception:
+        for sink in sinks:
+            sink.abort()
+        raise
+    # Closing a sink finishes pending work, compresses and uploads its archives
+    for sink in sinks:
+        with report.span(f"close:{sink.name}"):
+            sink.close()
+
+# Function to restore or add one collection in every sink, in collection order (the async encode stage).
+# documents is None when every sink was expected to restore; a sink that unexpectedly misses reads it here.
+def add_to_sinks(db, sinks, restorable, collection_index, collection_name, fingerprint, documents):
+    report = get_run_report()
+    for sink in sinks:
+        if sink in restorable and sink.restore(collection_index, collection_name, fingerprint):
+            continue
+        if sink not in restorable and sink.cache is not None:
+            # The fetch stage already found the cache stale, so restore() is skipped; count the miss here
+            sink.cache.record_miss(collection_name)
+        if documents is None:
+            consumers = [other.consumer for other in sinks if other.consumer is not None]
+            documents = []
+            if consumers:
+                with report.span("fetch", collection_name) as span:
+                    documents = list(find_documents(db, collection_name, consumers))
+                    span["documents"] = len(documents)
+        with report.span(sink.name, collection_name) as span:
+            sink.add(collection_index, collection_name, documents, fingerprint)
+            span["documents"] = len(documents)
+
+# Function to run the same export as run_pipeline as three overlapping asyncio stages:
+#   fetch  - checks the artifact cache and reads collections through the async client,
+#   encode - feeds each collection to the sinks in a worker thread (heavy Excel/chart work goes
+#            on to the sinks' process pools), in collection order,
+#   upload - zips and uploads every folder the sinks report as complete.
+# The bounded queues between the stages provide backpressure: fetching pauses while
+# async_queue_size collections are waiting to be encoded, and encoding pauses while a sink's pool
+# holds async_queue_size collections, so the queue limit caps the documents and DataFrames held.
+async def run_pipeline_async(db, async_db, zip_db, sinks, run_id=None, queue_size=None):
+    run_id = run_id or get_run_id()
+    report = get_run_report()
+    queue_size = queue_size or async_queue_size
+    for sink in sinks:
+        sink.open(zip_db, run_id)
+        if sink.max_in_flight is not None:
+            sink.max_in_flight = min(sink.max_in_flight, queue_size)
+    use_cache = any(sink.cache is not None for sink in sinks)
+    collection_names = await list_machine_collections(async_db)
+    total_collections = len(collection_names)
+    encode_queue = asyncio.Queue(maxsize=queue_size)
+    upload_queue = asyncio.Queue(maxsize=queue_size)
+
+    async def fetch():
+        for collection_index, collection_name in enumerate(collection_names):
+            restorable = []
+            fingerprint = None
+            if use_cache:
+                fingerprint = await asyncio.to_thread(get_collection_fingerprint, db, collection_name)
+                restorable = await asyncio.to_thread(
+                    lambda: [sink for sink in sinks if sink.is_restorable(collection_name, fingerprint)])
+            readers = [sink for sink in sinks if sink not in restorable]
+            consumers = [sink.consumer for sink in readers if sink.consumer is not None]
+            documents = None if not readers else []
+            if consumers:
+                with report.span("fetch", collection_name) as span:
+                    cursor = find_documents(async_db, collection_name, consumers)
+                    documents = await cursor.to_list()
+                    span["documents"] = len(documents)
+            await encode_queue.put((collection_index, collection_name, fingerprint, restorable, documents))
+        await encode_queue.put(None)
+
+    async def encode():
+        while (item := await encode_queue.get()) is not None:
+            collection_index, collection_name, fingerprint, restorable, documents = item
+            await asyncio.to_thread(add_to_sinks, db, sinks, restorable, collection_index, collection_name,
+                                    fingerprint, documents)
+            if documents is None:
+                report.count("cached_collections")
+            print(f"Exported {collection_name} ({0 if documents is None else len(documents)} documents). "
+                  f"({collection_index + 1} out of {total_collections})")
+            for sink in sinks:
+                for folder_name in sink.take_completed_folders():
+                    await upload_queue.put((sink, folder_name))
+        await upload_queue.put(None)
+
+    async def upload():
+        while (item := await upload_queue.get()) is not None:
+            sink, folder_name = item
+            with report.span(f"upload:{sink.name}"):
+                await asyncio.to_thread(sink.finish_folder, folder_name)
+
+    try:
+        # A failing stage cancels the other two
+        with report.span("scan"):
+            async with asyncio.TaskGroup() as stages:
+                stages.create_task(fetch())
+                stages.create_task(encode())
+                stages.create_task(upload())
+    except Exception:
+        for sink in sinks:
+            sink.abort()
+        raise
+    # Closing a sink finishes its last folder (or the streamed archive) and drops older archives
+    for sink in sinks:
+        with report.span(f"close:{sink.name}"):
+            await asyncio.to_thread(sink.close)
+
+# Function to run the async pipeline with its own async client, opened and closed on the event loop
+async def export_async(db, zip_db, sinks, run_id):
+    async_client = pymongo.AsyncMongoClient(target_mongo_url)
+    try:
+        await run_pipeline_async(db, async_client[target_db_name], zip_db, sinks, run_id)
+    finally:
+        await async_client.close()
+
+def main():
+    sink_names = sys.argv[1:] or [name.strip() for name in export_sinks.split(",") if name.strip()]
+    unknown = [name for name in sink_names if name not in sink_registry]
+    if unknown:
+        print(f"Unknown sink(s): {', '.join(unknown)}. Available: {', '.join(sink_registry)}")
+        sys.exit(1)
+
+    # One shared connection for the scan and every upload
+    client = pymongo.MongoClient(target_mongo_url)
+    try:
+        sinks = [sink_registry[name]() for name in sink_names]
+        print(f"Running export pipeline with sinks: {', '.join(sink_names)}")
+        run_id = get_run_id()
+        report = start_run_report("export_pipeline", run_id)
+        if pipeline_mode == "async":
+            asyncio.run(export_async(client[target_db_name], client['zip_files'], sinks, run_id))
+        else:
+            run_pipeline(client[target_db_name], client['zip_files'], sinks, run_id)
+        report.finish(client['zip_files'])
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,62 +1,54 @@
 import pandas as pd
 import pymongo
-from bson import ObjectId
-from datetime import datetime
+import xlsxwriter
+from concurrent.futures import as_completed
 import os
 import re
 import shutil
-import zipfile
-from gridfs import GridFS
+import sys
+import time
+from archive_store import build_archives, delete_old_archives, get_run_id
+from artifact_cache import open_artifact_cache, get_collection_fingerprint, prune_directory
+from timestamp_utils import format_timestamp, format_timestamp_column
+from mongo_reader import chunk_memory_budget_mb, find_documents, iter_document_chunks, list_machine_collections
+from process_pool import create_process_pool
+from run_report import start_run_report
+from rollups import find_rollups, has_complete_rollups, rollup_db_name, rollup_periods, rollups_to_rows
 
 pd.set_option('future.no_silent_downcasting', True)
 
-# Function to parse timestamp into date, day, and hour
+# Function to parse timestamp into date, day, and hour (memoized, see timestamp_utils)
 def parse_timestamp(timestamp):
-    try:
-        timestamp_obj = datetime.strptime(timestamp, '%A, %b %d, %Y, %I %p')
-        return timestamp_obj.strftime('%Y-%m-%d %H:%M:%S')
-    except ValueError:
-        return 'Invalid Timestamp'
+    return format_timestamp(timestamp)
 
 # Function to sanitize file names by replacing special characters with underscores
 def sanitize_file_name(name):
     return re.sub(r'\W+', '_', name)
 
-# Replace these values with your target MongoDB connection details
 # Replace these values with your target MongoDB connection details
 target_mongo_url = os.getenv("target_mongo_url")
 target_db_name = "channel_related_json"
 
-# Connect to MongoDB
-client = pymongo.MongoClient(target_mongo_url)
-db = client[target_db_name]
-
-    # Connect to the target MongoDB database for storing the zip file
-zip_db = client['zip_files']
-zip_collection = zip_db['excel_files']
-    # Check if the collection is not empty and delete its contents if it is not empty
-if zip_collection.count_documents({}) > 0:
-    
-    print("Collection 'excel_files' is not empty. Deleting all documents.")
-    zip_collection.delete_many({})
-    print("All documents in 'excel_files' collection have been deleted.")
-
-# Ensure the base directory exists
 base_directory = 'excel_folders'
-if os.path.exists(base_directory):
-    print(f"Base directory '{base_directory}' exists. Deleting it completely.")
-    shutil.rmtree(base_directory)
-    print(f"Base directory '{base_directory}' and its contents have been deleted.")
+max_collections_per_folder = 60
 
-# Create the base directory
-os.makedirs(base_directory)
+# "fast" writes with shared formats and row-wise writes; "pandas" keeps the original per-cell writer
+excel_writer_engine = os.getenv("excel_writer_engine", "fast")
+excel_constant_memory = os.getenv("excel_constant_memory") == "1"
 
-# Get all collection names in the database
-collection_names = db.list_collection_names()
+# Number of worker processes building workbooks; 1 keeps everything in this process
+excel_workers = int(os.getenv("excel_workers", "1"))
 
-total_files = len(collection_names)
-max_collections_per_folder = 60
-num_folders = (total_files + max_collections_per_folder - 1) // max_collections_per_folder
+# excel_source=raw writes every sample; hourly, daily or monthly writes one row per period (min, max,
+# mean and count of each metric) from the rollups kept by load_json.py. Machines without rollups
+# covering their whole history fall back to their raw documents.
+excel_source = os.getenv("excel_source", "raw")
+
+# Bump when the workbook content or layout changes, so cached workbooks are regenerated
+excel_cache_variant = f"xlsx-1:{excel_source}"
+
+# Exit with a non-zero status when any workbook failed
+excel_fail_on_error = os.getenv("excel_fail_on_error") == "1"
 
 # Function to save DataFrame to Excel with header formatting
 def save_df_to_excel(df, excel_file_path):
@@ -106,91 +98,323 @@ def save_df_to_excel(df, excel_file_path):
         print(f"Excel file saved: {excel_file_path}")
     except Exception as e:
         print(f"Failed to save file {excel_file_path} due to {e}")
+        raise
+
+# Header and data cell formats, shared by every cell instead of one format object per cell
+header_format_properties = {
+    'bold': True,
+    'text_wrap': True,
+    'valign': 'top',
+    'align': 'center',
+    'font_size': 11,
+    'fg_color': '#3EC6EC',  # Blue color
+    'border': 1
+}
+cell_format_properties = {
+    'fg_color': '#DDEBF7',  # Light blue color
+    'border': 1,
+    'align': 'center',
+    'font_size': 9,
+    'valign': 'vcenter'
+}
+
+# Function to save DataFrame to Excel with XlsxWriter directly: formats are created once,
+# data goes out one row at a time, and constant_memory flushes each row to disk as it is written.
+# Produces the same workbook look as save_df_to_excel.
+def save_df_to_excel_fast(df, excel_file_path, constant_memory=False):
+    try:
+        workbook = xlsxwriter.Workbook(excel_file_path, {'constant_memory': constant_memory})
+        try:
+            worksheet = workbook.add_worksheet('Sheet1')
+            header_format = workbook.add_format(header_format_properties)
+            cell_format = workbook.add_format(cell_format_properties)
 
-# Function to zip a directory and return the zip file path
-def zip_directory(directory_path):
-    zip_file_path = f"{directory_path}.zip"
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(directory_path):
-            for file in files:
-                zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), directory_path))
-    print(f"Directory '{directory_path}' has been zipped into {zip_file_path}")
-    return zip_file_path
-
-# Process collections and save to folders
-for folder_index in range(num_folders):
-    folder_name = f"folder_{folder_index + 1}"
-    folder_path = os.path.join(base_directory, folder_name)
-    os.makedirs(folder_path)
-
-    start_index = folder_index * max_collections_per_folder
-    end_index = min((folder_index + 1) * max_collections_per_folder, total_files)
-
-    for idx in range(start_index, end_index):
-        collection_name = collection_names[idx]
-        collection = db[collection_name]
-
-        # Fetch all documents from the collection
-        documents = collection.find()
-
-        # Convert ObjectId fields to string representation
-        def convert_object_ids(doc):
-            for key in doc:
-                if isinstance(doc[key], ObjectId):
-                    doc[key] = str(doc[key])
-            return doc
-
-        documents_list = [convert_object_ids(doc) for doc in documents]
-
-        # Parse "Timestamp" field into a formatted string
-        for doc in documents_list:
-            if "Timestamp" in doc:
-                doc["Timestamp"] = parse_timestamp(doc["Timestamp"])
-
-        # Create DataFrame and drop the '_id' column
-        df = pd.DataFrame(documents_list)
-        if '_id' in df.columns:
-            df.drop('_id', axis=1, inplace=True)
-
-        # Replace NaN and infinite values with a placeholder value (e.g., 'NA')
-        df = df.fillna('NA').astype(object)
-        df.replace([float('inf'), float('-inf')], 'NA', inplace=True)
-
-        # Sanitize collection name to use it as a file name
-        sanitized_collection_name = sanitize_file_name(collection_name)
-        excel_file_path = os.path.join(folder_path, f"{sanitized_collection_name}.xlsx")
-
-        # Save DataFrame to Excel
-        save_df_to_excel(df, excel_file_path)
-
-# Zip each folder and save to MongoDB
-for folder_index in range(num_folders):
-    folder_name = f"folder_{folder_index + 1}"
-    folder_path = os.path.join(base_directory, folder_name)
-
-    # Zip the folder
-    zip_file_path = zip_directory(folder_path)
-
-
+            # Column widths: longest value or header, computed per column in one vectorized pass
+            for i, col in enumerate(df.columns):
+                longest_value = df[col].astype(str).str.len().max() if len(df) else 0
+                worksheet.set_column(i, i, max(longest_value, len(col)))
 
+            worksheet.write_row(0, 0, list(df.columns.values), header_format)
+            for row_num, row in enumerate(df.itertuples(index=False, name=None), start=1):
+                worksheet.write_row(row_num, 0, row, cell_format)
 
-    # Read the zip file and insert it into MongoDB
-    with open(zip_file_path, 'rb') as file_data:
-        zip_binary = file_data.read()
-        zip_document = {
-            "filename": f"{folder_name}.zip",
-            "filedata": zip_binary
-        }
-        zip_collection.insert_one(zip_document)
+            # Add filter to every column
+            worksheet.autofilter(0, 0, len(df), len(df.columns) - 1)
+        finally:
+            workbook.close()
 
-    print(f"Zip file '{zip_file_path}' has been saved to MongoDB successfully.")
+        print(f"Excel file saved: {excel_file_path}")
+    except Exception as e:
+        print(f"Failed to save file {excel_file_path} due to {e}")
+        raise
+
+# Function to save a collection to Excel one chunk of documents at a time (see chunk_memory_budget_mb).
+# Each chunk is cleaned like documents_to_dataframe and appended in constant_memory mode, so only one
+# chunk is ever held; column widths are tracked across chunks and set before closing. The header is
+# written first, so the columns of the whole collection are given up front (see get_field_names).
+# Same workbook look as save_df_to_excel_fast. Returns the rows written.
+def save_chunks_to_excel(chunks, excel_file_path, columns):
+    try:
+        workbook = xlsxwriter.Workbook(excel_file_path, {'constant_memory': True})
+        try:
+            worksheet = workbook.add_worksheet('Sheet1')
+            header_format = workbook.add_format(header_format_properties)
+            cell_format = workbook.add_format(cell_format_properties)
+
+            column_widths = [len(col) for col in columns]
+            if columns:
+                worksheet.write_row(0, 0, columns, header_format)
+            row_count = 0
+            for chunk in chunks:
+                # Fields a chunk lacks are 'NA', as when the whole collection is in one DataFrame
+                df = documents_to_dataframe(chunk).reindex(columns=columns, fill_value='NA')
+                for i, col in enumerate(columns):
+                    if len(df):
+                        column_widths[i] = max(column_widths[i], df[col].astype(str).str.len().max())
+                for row in df.itertuples(index=False, name=None):
+                    row_count += 1
+                    worksheet.write_row(row_count, 0, row, cell_format)
+
+            if columns:
+                for i, column_width in enumerate(column_widths):
+                    worksheet.set_column(i, i, column_width)
+                # Add filter to every column
+                worksheet.autofilter(0, 0, row_count, len(columns) - 1)
+        finally:
+            workbook.close()
 
-    # Delete the zip file from local storage
+        print(f"Excel file saved: {excel_file_path}")
+        return row_count
+    except Exception as e:
+        print(f"Failed to save file {excel_file_path} due to {e}")
+        raise
+
+# Function to get every field name of a collection except _id, in order of first appearance like
+# the columns of documents_to_dataframe. The distinct field lists are collected on the server.
+def get_field_names(db, collection_name):
+    schemas = db[collection_name].aggregate([
+        {"$group": {"_id": {"$map": {"input": {"$objectToArray": "$$ROOT"}, "in": "$$this.k"}},
+                    "first_id": {"$min": "$_id"}}},
+        {"$sort": {"first_id": 1}}
+    ], allowDiskUse=True)
+    field_names = {}
+    for schema in schemas:
+        field_names.update(dict.fromkeys(field for field in schema["_id"] if field != "_id"))
+    return list(field_names)
+
+# Function to build the cleaned DataFrame written to Excel from collection documents.
+# The documents themselves are not modified.
+def documents_to_dataframe(documents):
+    # Create DataFrame and drop the '_id' column
+    df = pd.DataFrame(list(documents))
+    if '_id' in df.columns:
+        df.drop('_id', axis=1, inplace=True)
+
+    # Parse "Timestamp" column into formatted strings, one strptime per distinct value
+    if 'Timestamp' in df.columns:
+        df['Timestamp'] = format_timestamp_column(df['Timestamp'])
+
+    # Replace NaN and infinite values with a placeholder value (e.g., 'NA')
+    df = df.fillna('NA').astype(object)
+    df.replace([float('inf'), float('-inf')], 'NA', inplace=True)
+    return df
+
+# Function to fetch a collection (or its rollups) and build the cleaned DataFrame written to Excel
+def build_collection_dataframe(db, collection_name):
+    if excel_source in rollup_periods:
+        rollup_db = db.client[rollup_db_name]
+        if has_complete_rollups(db, rollup_db, collection_name):
+            return documents_to_dataframe(rollups_to_rows(find_rollups(rollup_db, collection_name, excel_source)))
+    # Fetch all documents from the collection, without _id
+    return documents_to_dataframe(find_documents(db, collection_name, "excel"))
+
+# Function to tell whether a collection is written in chunks: chunked mode is on and the rows come
+# from the raw documents rather than from (small) rollups
+def is_chunked_export(db, collection_name):
+    if not chunk_memory_budget_mb:
+        return False
+    return excel_source not in rollup_periods or not has_complete_rollups(db, db.client[rollup_db_name], collection_name)
+
+# Function to get the .xlsx path of a collection inside its folder
+def get_excel_file_path(folder_path, collection_name):
+    # Sanitize collection name to use it as a file name
+    sanitized_collection_name = sanitize_file_name(collection_name)
+    return os.path.join(folder_path, f"{sanitized_collection_name}.xlsx")
+
+# Function to write a collection's DataFrame with the configured writer and report the outcome.
+# Timings travel back in the result because workers do not share the parent's run report.
+def write_collection_workbook(collection_name, df, excel_file_path):
+    start_time = time.perf_counter()
     try:
-        os.remove(zip_file_path)
-        print(f"Zip file '{zip_file_path}' has been deleted from local storage.")
-    except OSError as e:
-        print(f"Error: {zip_file_path} : {e.strerror}")
+        # Save DataFrame to Excel
+        if excel_writer_engine == "fast":
+            save_df_to_excel_fast(df, excel_file_path, constant_memory=excel_constant_memory)
+        else:
+            save_df_to_excel(df, excel_file_path)
+        return {"collection": collection_name, "file": excel_file_path, "rows": len(df), "status": "ok",
+                "seconds": time.perf_counter() - start_time, "bytes": os.path.getsize(excel_file_path)}
+    except Exception as e:
+        print(f"Failed to export collection {collection_name} due to {e}")
+        return {"collection": collection_name, "file": excel_file_path, "status": "failed", "error": str(e)}
 
-# Close the MongoDB connection
-client.close()
+# Function to stream a collection into its workbook chunk by chunk and report the outcome.
+# Reading and writing are interleaved, so their time is reported together.
+def write_collection_workbook_chunked(collection_name, db, excel_file_path):
+    start_time = time.perf_counter()
+    try:
+        row_count = save_chunks_to_excel(iter_document_chunks(db, collection_name, "excel"), excel_file_path,
+                                         get_field_names(db, collection_name))
+        return {"collection": collection_name, "file": excel_file_path, "rows": row_count, "status": "ok",
+                "seconds": time.perf_counter() - start_time, "bytes": os.path.getsize(excel_file_path)}
+    except Exception as e:
+        print(f"Failed to export collection {collection_name} due to {e}")
+        return {"collection": collection_name, "file": excel_file_path, "status": "failed", "error": str(e)}
+
+# Function to export one collection to an .xlsx file and report the outcome
+def export_collection(db, collection_name, folder_path):
+    excel_file_path = get_excel_file_path(folder_path, collection_name)
+    if is_chunked_export(db, collection_name):
+        return write_collection_workbook_chunked(collection_name, db, excel_file_path)
+    start_time = time.perf_counter()
+    try:
+        df = build_collection_dataframe(db, collection_name)
+    except Exception as e:
+        print(f"Failed to export collection {collection_name} due to {e}")
+        return {"collection": collection_name, "file": excel_file_path, "status": "failed", "error": str(e)}
+    fetch_seconds = time.perf_counter() - start_time
+    return dict(write_collection_workbook(collection_name, df, excel_file_path), fetch_seconds=fetch_seconds)
+
+# Function to copy the timings carried by export results into the run report
+def record_export_results(report, results):
+    for result in results:
+        if result.get("cached"):
+            report.count("cached_collections")
+            continue
+        if "fetch_seconds" in result:
+            report.add("fetch", result["collection"], seconds=result["fetch_seconds"], documents=result.get("rows", 0))
+        report.add("encode", result["collection"], seconds=result.get("seconds", 0.0),
+                   documents=result.get("rows", 0), bytes=result.get("bytes", 0), errors=int(result["status"] != "ok"))
+
+# Each worker process opens its own MongoDB connection once, in the pool initializer
+worker_client = None
+
+# Function to set up the MongoDB connection of a worker process
+def init_worker(mongo_url):
+    global worker_client
+    worker_client = pymongo.MongoClient(mongo_url)
+
+# Function run inside a worker process for one collection
+def export_collection_in_worker(collection_name, folder_path):
+    return export_collection(worker_client[target_db_name], collection_name, folder_path)
+
+# Function to assign collections to folder_N in fixed-size batches, in collection order
+def assign_collections_to_folders(collection_names, collections_per_folder):
+    return [(collection_name, f"folder_{idx // collections_per_folder + 1}")
+            for idx, collection_name in enumerate(collection_names)]
+
+# Function to export every (collection, folder) task, sequentially or across a process pool.
+# Results come back in task order whatever order the workers finish in. With an artifact cache,
+# collections whose fingerprint is unchanged reuse their previous workbook and are not fetched.
+def export_collections(db, tasks, workers=1, cache=None):
+    results = [None] * len(tasks)
+    fingerprints = {}
+    pending = []
+    for idx, (collection_name, folder_name) in enumerate(tasks):
+        folder_path = os.path.join(base_directory, folder_name)
+        if cache is not None:
+            fingerprints[idx] = get_collection_fingerprint(db, collection_name, excel_cache_variant)
+            excel_file_path = get_excel_file_path(folder_path, collection_name)
+            if cache.restore(collection_name, fingerprints[idx], excel_file_path):
+                results[idx] = {"collection": collection_name, "file": excel_file_path, "status": "ok", "cached": True}
+                continue
+        pending.append((idx, collection_name, folder_path))
+
+    if workers <= 1:
+        for idx, collection_name, folder_path in pending:
+            results[idx] = export_collection(db, collection_name, folder_path)
+    else:
+        with create_process_pool(workers, initializer=init_worker, initargs=(target_mongo_url,)) as executor:
+            futures = {
+                executor.submit(export_collection_in_worker, collection_name, folder_path): idx
+                for idx, collection_name, folder_path in pending
+            }
+            for completed, future in enumerate(as_completed(futures), start=1):
+                idx = futures[future]
+                collection_name, folder_name = tasks[idx]
+                try:
+                    results[idx] = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. killed for memory); record it and keep going
+                    results[idx] = {"collection": collection_name, "status": "failed", "error": repr(e)}
+                print(f"Finished {collection_name} ({completed}/{len(pending)}): {results[idx]['status']}")
+
+    if cache is not None:
+        for idx, collection_name, folder_path in pending:
+            if results[idx]["status"] == "ok":
+                cache.store(collection_name, fingerprints[idx], results[idx]["file"])
+    return results
+
+def main():
+    # Connect to MongoDB
+    client = pymongo.MongoClient(target_mongo_url)
+    db = client[target_db_name]
+
+    # Connect to the target MongoDB database for storing the zip files
+    zip_db = client['zip_files']
+    run_id = get_run_id()
+    report = start_run_report("load_excel_file", run_id)
+
+    # With an artifact cache the folders are kept between runs and only stale files are pruned
+    cache = open_artifact_cache("excel", client)
+
+    # Ensure the base directory exists
+    if os.path.exists(base_directory) and cache is None:
+        print(f"Base directory '{base_directory}' exists. Deleting it completely.")
+        shutil.rmtree(base_directory)
+        print(f"Base directory '{base_directory}' and its contents have been deleted.")
+
+    # Create the base directory
+    os.makedirs(base_directory, exist_ok=True)
+
+    # Get all collection names in the database
+    collection_names = list_machine_collections(db)
+
+    # Same folder layout as the sequential batching: the first 60 collections go to folder_1, ...
+    tasks = assign_collections_to_folders(collection_names, max_collections_per_folder)
+    folder_names = list(dict.fromkeys(folder_name for _, folder_name in tasks))
+    for folder_name in folder_names:
+        os.makedirs(os.path.join(base_directory, folder_name), exist_ok=True)
+
+    # Process collections and save to folders
+    print(f"Exporting {len(tasks)} collections with {excel_workers} worker(s).")
+    with report.span("export") as span:
+        results = export_collections(db, tasks, excel_workers, cache)
+        span["documents"] = sum(result.get("rows", 0) for result in results)
+        span["bytes"] = sum(result.get("bytes", 0) for result in results)
+    record_export_results(report, results)
+    if cache is not None:
+        cache.close()
+        prune_directory(base_directory, [result["file"] for result in results if result["status"] == "ok"])
+
+    failed = [result for result in results if result["status"] != "ok"]
+    print(f"{len(results) - len(failed)} workbooks written, {len(failed)} failed.")
+    for result in failed:
+        print(f"  {result['collection']}: {result['error']}")
+
+    # Pack the workbooks, in collection order, into size-bounded archives and stream them into MongoDB
+    with report.span("compress_upload") as span:
+        archives = build_archives(zip_db, 'excel_files', [result["file"] for result in results if result["status"] == "ok"], run_id)
+        span["bytes"] = sum(archive.size for archive in archives)
+
+    # Only drop the previous archives once the new ones are fully uploaded
+    delete_old_archives(zip_db, 'excel_files', keep_run_id=run_id)
+    report.finish(zip_db)
+
+    # Close the MongoDB connection
+    client.close()
+
+    if failed and excel_fail_on_error:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,40 @@
 import os
 import re
 import time
-from datetime import datetime
 import pymongo
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib
 import matplotlib.dates as mdates
-import zipfile
+from matplotlib.artist import setp
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
 from scipy.stats import zscore
 from PIL import Image
 import io
+from archive_store import build_archives, delete_old_archives, get_run_id
+from artifact_cache import open_artifact_cache, get_collection_fingerprint, prune_directory
+from timestamp_utils import parse_timestamp_column, parse_timestamp_value
+from mongo_reader import chunk_memory_budget_mb, find_documents, iter_document_chunks, list_machine_collections
+from process_pool import create_process_pool
+from run_report import get_run_report, start_run_report
+from rollups import find_rollups, has_complete_rollups, rollup_db_name, rollup_periods
 
-# MongoDB connection details
-# Get the MongoDB URL from the environment variable
-target_mongo_url = os.getenv("target_mongo_url")
-if not target_mongo_url:
-    print("MongoDB URL not found in environment variables.")
-    exit(1)
+# Charts are only ever written to files, so never touch an interactive backend
+matplotlib.use("Agg")
 
 target_db_name = "channel_related_json"
 
-# Connect to the MongoDB client
-client = pymongo.MongoClient(target_mongo_url)
-db = client[target_db_name]
-print(f"Connected to MongoDB database '{target_db_name}'.")
+# Split collections into multiple folders
+collections_per_folder = 70
+
+# Number of chart rendering worker processes; 1 renders in this process
+img_workers = int(os.getenv("img_workers", "1"))
 
-# Get a list of collection names
-collection_names = db.list_collection_names()
-total_collections = len(collection_names)
-print(f"Total collections found: {total_collections}")
+# chart_source=raw plots every sample; hourly, daily or monthly plots the lowest and highest value of
+# each period from the rollups kept by load_json.py, so a chart costs the same whatever the history length.
+# Machines without rollups covering their whole history fall back to their raw documents.
+chart_source = os.getenv("chart_source", "raw")
 
 # Function to remove outliers using Z-score
 def remove_outliers_zscore(data):
@@ -37,195 +43,414 @@ def remove_outliers_zscore(data):
     filtered_entries = (abs_z_scores < 5)  # Threshold for Z-score
     return filtered_entries
 
-# Function to compress images
-def compress_image(image_path, output_path, max_size_kb=50):
-    quality = 95
-    while quality > 0:
-        img = Image.open(image_path)
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG', quality=quality)
-        size_kb = len(img_byte_arr.getvalue()) / 1024
-        if size_kb <= max_size_kb:
-            with open(output_path, 'wb') as f:
-                f.write(img_byte_arr.getvalue())
-            return
-        quality -= 5
-    img.save(output_path, format='PNG', quality=quality)
-
-# Split collections into multiple folders
-collections_per_folder = 70
-total_folders = (total_collections // collections_per_folder) + (1 if total_collections % collections_per_folder else 0)
-
-# Process each collection and save images to respective folders
-for folder_idx in range(total_folders):
-    folder_name = f"folder_{folder_idx + 1}"
-    output_folder = os.path.join("temp_img_files", folder_name)
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    
-    start_idx = folder_idx * collections_per_folder
-    end_idx = min(start_idx + collections_per_folder, total_collections)
-    
-    for idx, collection_name in enumerate(collection_names[start_idx:end_idx], 1):
+# Hour categories and their chart colours, in hour order (00-05, 06-11, 12-17, 18-23)
+hour_category_labels = ['00:00 - 05:59', '06:00 - 11:59', '12:00 - 17:59', '18:00 - 23:59']
+hour_category_colors = np.array(['blue', 'green', 'orange', 'red'])
+
+# Function to categorize an array of hours into hour-category indexes
+def categorize_hours(hours):
+    return np.clip(np.asarray(hours, dtype=int) // 6, 0, 3)
+
+# Function to get the chart colour of every hour in an array
+def get_hour_colors(hours):
+    return hour_category_colors[categorize_hours(hours)]
+
+# Point reduction between the outlier filter and plotting, so render time and PNG size stay flat as
+# histories grow: chart_reduction=minmax keeps the lowest and highest point of both series per time
+# bucket and hour category, chart_reduction=lttb keeps the Largest-Triangle-Three-Buckets shape
+# points, chart_reduction=none plots everything. Charts with at most chart_max_points are untouched.
+chart_reduction = os.getenv("chart_reduction", "minmax")
+chart_max_points = int(os.getenv("chart_max_points", "4000"))
+
+# Function to get, per group, the index of the lowest and of the highest non-NaN value
+def group_extreme_indices(values, groups):
+    indices = []
+    for missing_as in (np.inf, -np.inf):
+        order = np.lexsort((np.where(np.isnan(values), missing_as, values), groups))
+        sorted_groups = groups[order]
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        # Lowest value is first in its group when NaN sorts high, highest is last when NaN sorts low
+        indices.append(order[starts] if missing_as == np.inf else order[np.r_[starts[1:], len(order)] - 1])
+    return np.concatenate(indices)
+
+# Function to pick the min/max points of both series in each (time bucket, hour category) group
+def minmax_indices(times, series, max_points):
+    # Up to 2 points per series for each of the 4 hour categories in a bucket
+    bucket_count = max(max_points // (4 * len(hour_category_labels)), 1)
+    span = max(times.max() - times.min(), 1)
+    buckets = np.minimum((times - times.min()) * bucket_count // span, bucket_count - 1)
+    groups = buckets * len(hour_category_labels) + categorize_hours((times // 3600) % 24)
+    return np.concatenate([group_extreme_indices(values, groups) for values in series])
+
+# Function to pick threshold points of one series with Largest-Triangle-Three-Buckets (times sorted)
+def lttb_indices(times, values, threshold):
+    count = len(times)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    # NaN points are not drawn; give them a neutral value so they do not steer the selection
+    values = np.where(np.isnan(values), np.nanmean(values) if not np.isnan(values).all() else 0.0, values)
+    times = times.astype(float)
+    bucket_size = (count - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, count - 1
+    selected = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+        average_time = times[end:next_end].mean()
+        average_value = values[end:next_end].mean()
+        areas = np.abs((times[selected] - average_time) * (values[start:end] - values[selected])
+                       - (times[selected] - times[start:end]) * (average_value - values[selected]))
+        selected = start + int(np.argmax(areas))
+        indices[bucket + 1] = selected
+    return indices
+
+# Function to reduce the chart arrays to about chart_max_points, keeping each series' overall
+# lowest and highest point (so the reported min/max stay exact) and the points' own hour colours.
+# Kept points stay in their original order.
+def reduce_chart_points(timestamps, profits, full_profits, method=None, max_points=None):
+    method = method or chart_reduction
+    max_points = max_points or chart_max_points
+    if method == "none" or len(timestamps) <= max_points:
+        return timestamps, profits, full_profits
+    times = timestamps.astype('datetime64[s]').astype(np.int64)
+    series = [profits, full_profits]
+    if method == "lttb":
+        order = np.argsort(times, kind='stable')
+        keep = np.concatenate([order[lttb_indices(times[order], values[order], max_points // 2)] for values in series])
+    elif method == "minmax":
+        keep = minmax_indices(times, series, max_points)
+    else:
+        raise ValueError(f"Unknown chart_reduction '{method}'")
+    extremes = [np.nanargmin(values) for values in series if not np.isnan(values).all()] + \
+               [np.nanargmax(values) for values in series if not np.isnan(values).all()]
+    keep = np.unique(np.concatenate([keep, np.asarray(extremes, dtype=np.int64)]))
+    return timestamps[keep], profits[keep], full_profits[keep]
+
+# Resolution steps and palette sizes tried, in order, until a chart fits its size budget
+compression_dpi_steps = [100, 80, 64]
+compression_palette_steps = [256, 64, 16]
+
+# Bump when the chart look or compression changes, so cached charts are regenerated
+img_cache_variant = f"png-1:{compression_dpi_steps}:{compression_palette_steps}:{chart_reduction}:{chart_max_points}:{chart_source}"
+
+# Function to render a figure in memory and save it as a PNG that fits within max_size_kb.
+# Palette quantization plus optimize=True is what actually shrinks a PNG; if that is not
+# enough the figure is re-rendered at a lower DPI. Stops at the first attempt that fits.
+def save_compressed_figure(fig, output_path, max_size_kb=50):
+    smallest = None
+    for dpi in compression_dpi_steps:
+        render_buffer = io.BytesIO()
+        fig.savefig(render_buffer, format='png', dpi=dpi)
+        render_buffer.seek(0)
+        img = Image.open(render_buffer).convert('RGB')
+        for colors in compression_palette_steps:
+            img_byte_arr = io.BytesIO()
+            img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE).save(img_byte_arr, format='PNG', optimize=True)
+            png_bytes = img_byte_arr.getvalue()
+            if smallest is None or len(png_bytes) < len(smallest):
+                smallest = png_bytes
+            if len(png_bytes) <= max_size_kb * 1024:
+                return write_compressed_png(output_path, png_bytes, max_size_kb)
+    # Nothing fit the budget: keep the smallest attempt
+    return write_compressed_png(output_path, smallest, max_size_kb)
+
+# Function to write the final PNG bytes and report their size
+def write_compressed_png(output_path, png_bytes, max_size_kb):
+    with open(output_path, 'wb') as f:
+        f.write(png_bytes)
+    size_kb = len(png_bytes) / 1024
+    status = "within" if size_kb <= max_size_kb else "over"
+    print(f"Saved {output_path}: {size_kb:.1f} KB ({status} the {max_size_kb} KB budget)")
+    return size_kb
+
+# Function to fetch a collection (or its rollups) and build the three arrays its chart needs
+def load_chart_data(db, collection_name):
+    if chart_source in rollup_periods:
+        rollup_db = db.client[rollup_db_name]
+        if has_complete_rollups(db, rollup_db, collection_name):
+            return chart_data_from_rollups(find_rollups(rollup_db, collection_name, chart_source))
+    # Only the three plotted fields are fetched
+    if chunk_memory_budget_mb:
+        return chart_data_from_chunks(iter_document_chunks(db, collection_name, "chart"))
+    return chart_data_from_documents(list(find_documents(db, collection_name, "chart")))
+
+# Function to build the three chart arrays from rollups: each period contributes its lowest and
+# its highest value, plotted at the start of the period
+def chart_data_from_rollups(rollups):
+    timestamps = []
+    profits_per_day = []
+    total_profits = []
+    unknown = 0
+    for rollup in rollups:
+        if not rollup.get("profits", {}).get("count") or not rollup.get("full_profits", {}).get("count"):
+            unknown += 1
+            continue
+        for statistic in ("min", "max"):
+            timestamps.append(rollup["period_start"])
+            profits_per_day.append(rollup["profits"][statistic])
+            total_profits.append(rollup["full_profits"][statistic])
+    check_known_values(timestamps, unknown)
+    return build_chart_arrays(timestamps, profits_per_day, total_profits)
+
+# Function to fail a chart whose documents all lack a value (an "unknown" rentability is stored as
+# None). An empty collection, or one whose values are all filtered out later, still gets its chart.
+def check_known_values(timestamps, unknown):
+    if len(timestamps) == 0 and unknown:
+        raise ValueError(f"all {unknown} values are unknown")
+
+# Function to build the three chart arrays from raw collection documents. Documents without a value
+# are not plotted; they would turn every z-score into NaN.
+def chart_data_from_documents(documents):
+    timestamps = []
+    profits_per_day = []
+    total_profits = []
+    unknown = 0
+
+    for doc in documents:
         try:
-            start_time = time.time()
-            print(f"\nProcessing collection {idx + start_idx} out of {total_collections}: {collection_name}")
-
-            collection = db[collection_name]
-            documents = list(collection.find())
-
-            timestamps = []
-            profits_per_day = []
-            total_profits = []
-
-            for doc in documents:
-                try:
-                    timestamps.append(datetime.strptime(doc["Timestamp"], "%A, %b %d, %Y, %I %p"))
-                    profits_per_day.append(doc["Profits Per Day ($)"])
-                    total_profits.append(doc["Profits Without Expenses ($)"])
-                except Exception as e:
-                    print(f"Error processing document {doc}: {e}")
-
-            # Remove outliers
-            profits_per_day_filtered = [p for p, valid in zip(profits_per_day, remove_outliers_zscore(profits_per_day)) if valid]
-            total_profits_filtered = [p for p, valid in zip(total_profits, remove_outliers_zscore(total_profits)) if valid]
-            timestamps_filtered = [t for t, valid in zip(timestamps, remove_outliers_zscore(profits_per_day)) if valid]
-
-            ymin_profits_per_day = min(profits_per_day_filtered, default=0)
-            ymax_profits_per_day = max(profits_per_day_filtered, default=0)
-            ymin_total_profits = min(total_profits_filtered, default=0)
-            ymax_total_profits = max(total_profits_filtered, default=0)
-
-            data = {
-                'timestamp': timestamps_filtered,
-                'profit': profits_per_day_filtered,
-                'full_profit': total_profits_filtered
-            }
-            df = pd.DataFrame(data)
-
-            def categorize_hour(hour):
-                if hour >= 0 and hour < 6:
-                    return '00:00 - 05:59'
-                elif hour >= 6 and hour < 12:
-                    return '06:00 - 11:59'
-                elif hour >= 12 and hour < 18:
-                    return '12:00 - 17:59'
-                else:
-                    return '18:00 - 23:59'
-
-            def get_color(hour):
-                category = categorize_hour(hour)
-                if category == '00:00 - 05:59':
-                    return 'blue'
-                elif category == '06:00 - 11:59':
-                    return 'green'
-                elif category == '12:00 - 17:59':
-                    return 'orange'
-                else:
-                    return 'red'
-
-            fig, axs = plt.subplots(2, 1, figsize=(24, 20))
-
-            for idx, row in df.iterrows():
-                hour = row['timestamp'].hour
-                color = get_color(hour)
-                axs[0].scatter(row['timestamp'], row['profit'], color=color)
-                axs[1].scatter(row['timestamp'], row['full_profit'], color=color)
-
-            axs[0].set_xlabel('Timestamp')
-            axs[0].set_ylabel('Profits Per Day ($)')
-            axs[0].set_ylim(ymin_profits_per_day - 5, ymax_profits_per_day + 10)
-            axs[0].set_title(f'{collection_name} - Profits Per Day Electricity Included \n\n Low Value during period {ymin_profits_per_day} \n Highest Value during period {ymax_profits_per_day}')
-
-            axs[1].set_xlabel('Timestamp')
-            axs[1].set_ylabel('Profits Without Expenses ($)')
-            axs[1].set_ylim(ymin_total_profits - 5, ymax_total_profits + 10)
-            axs[1].set_title(f'{collection_name} - Total Profits Without Expenses \n\n Lowest Value during period {ymin_total_profits} \n Highest Value during period {ymax_total_profits}')
-
-            for ax in axs:
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
-                plt.setp(ax.get_xticklabels(), rotation=60)
-
-            handles = [
-                plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='blue', markersize=10, label='00:00 - 05:59'),
-                plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='green', markersize=10, label='06:00 - 11:59'),
-                plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='orange', markersize=10, label='12:00 - 17:59'),
-                plt.Line2D([0], [0], marker='o', color='w', markerfacecolor='red', markersize=10, label='18:00 - 23:59')
-            ]
-
-            axs[0].legend(handles=handles, title='Hour Category', bbox_to_anchor=(1, 1), loc='upper left')
-            axs[1].legend(handles=handles, title='Hour Category', bbox_to_anchor=(1, 1), loc='upper left')
-            # Enabling both grid lines:
-            axs[0].grid(which = "both")
-            axs[0].minorticks_on()
-            axs[0].tick_params(which = "minor", bottom = False, left = False)
-
-            plt.subplots_adjust(hspace=0.6)
-            plt.tight_layout()
-
-            sanitized_collection_name = re.sub(r'\W+', '_', collection_name)
-            output_file = os.path.join(output_folder, f"{sanitized_collection_name}.png")
-            temp_output_file = os.path.join(output_folder, f"temp_{sanitized_collection_name}.png")
-            
-            # Save the plot to a temporary file first
-            plt.savefig(temp_output_file)
-            plt.close()
-
-            # Compress the image
-            compress_image(temp_output_file, output_file)
-
-            # Remove the temporary file
-            os.remove(temp_output_file)
-
-            end_time = time.time()
-            execution_time = end_time - start_time
-            print(f"Total execution time for {collection_name}: {execution_time:.2f} seconds\n\n")
-
+            timestamp = parse_timestamp_value(doc["Timestamp"])
+            profit = doc["Profits Per Day ($)"]
+            total_profit = doc["Profits Without Expenses ($)"]
         except Exception as e:
-            print(f"Error processing collection {collection_name}: {e}")
-
-# Zip each folder and save to MongoDB
-zip_db = client['zip_files']
-zip_collection = zip_db['img_files']
-
-# Check if the collection is not empty and delete its contents if it is not empty
-if zip_collection.count_documents({}) > 0:
-    print("Collection 'img_files' is not empty. Deleting all documents.")
-    zip_collection.delete_many({})
-    print("All documents in 'img_files' collection have been deleted.")
-
-for folder_idx in range(total_folders):
-    folder_name = f"folder_{folder_idx + 1}"
-    output_folder = os.path.join("temp_img_files", folder_name)
-    zip_file_path = f"{folder_name}.zip"
-    
-    # Zip the folder
-    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(output_folder):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, output_folder)
-                zipf.write(file_path, arcname)
-
-    print(f"Directory '{output_folder}' has been zipped into '{zip_file_path}'.")
-
-    # Read the zip file and insert it into MongoDB
-    with open(zip_file_path, 'rb') as file_data:
-        zip_binary = file_data.read()
-        zip_document = {
-            "filename": zip_file_path,
-            "filedata": zip_binary
-        }
-        zip_collection.insert_one(zip_document)
-
-    print(f"Zip file '{zip_file_path}' has been saved to MongoDB successfully.")
-
-    # Delete the zip file from local storage
+            print(f"Error processing document {doc}: {e}")
+            continue
+        if pd.isna(profit) or pd.isna(total_profit):
+            unknown += 1
+            continue
+        timestamps.append(timestamp)
+        profits_per_day.append(profit)
+        total_profits.append(total_profit)
+    check_known_values(timestamps, unknown)
+    return build_chart_arrays(timestamps, profits_per_day, total_profits)
+
+# Function to build the three chart arrays from chunks of raw documents (see chunk_memory_budget_mb).
+# Each chunk is turned into typed arrays (24 bytes per point) and dropped before the next is read.
+# Documents missing a field, without a value or with an invalid timestamp are skipped, like
+# chart_data_from_documents.
+def chart_data_from_chunks(chunks):
+    fields = ["Timestamp", "Profits Per Day ($)", "Profits Without Expenses ($)"]
+    timestamps = []
+    profits_per_day = []
+    total_profits = []
+    unknown = 0
+    for chunk in chunks:
+        df = pd.DataFrame.from_records(chunk, columns=fields)
+        times = parse_timestamp_column(df["Timestamp"])
+        known = df[fields[1]].notna().to_numpy() & df[fields[2]].notna().to_numpy()
+        valid = ~np.isnat(times) & known
+        unknown += int((~np.isnat(times) & ~known).sum())
+        timestamps.append(times[valid])
+        profits_per_day.append(df[fields[1]].to_numpy(dtype=float)[valid])
+        total_profits.append(df[fields[2]].to_numpy(dtype=float)[valid])
+    if not timestamps:
+        return build_chart_arrays([], [], [])
+    check_known_values(np.concatenate(timestamps), unknown)
+    return build_chart_arrays(np.concatenate(timestamps), np.concatenate(profits_per_day), np.concatenate(total_profits))
+
+# Function to filter outliers out of the chart values and reduce them to the plotted arrays
+def build_chart_arrays(timestamps, profits_per_day, total_profits):
+    # Remove outliers, with boolean masks instead of per-value Python lists
+    profits_per_day = np.asarray(profits_per_day, dtype=float)
+    total_profits = np.asarray(total_profits, dtype=float)
+    valid_profits = remove_outliers_zscore(profits_per_day)
+
+    data = {
+        'timestamp': np.asarray(timestamps)[valid_profits],
+        'profit': profits_per_day[valid_profits],
+        'full_profit': total_profits[remove_outliers_zscore(total_profits)]
+    }
+    df = pd.DataFrame(data)
+    return reduce_chart_points(pd.to_datetime(df['timestamp']).to_numpy(),
+                               df['profit'].to_numpy(dtype=float),
+                               df['full_profit'].to_numpy(dtype=float))
+
+# Function to draw a chart on its own Figure (no pyplot global state, safe in any process)
+def render_chart(collection_name, timestamps, profits, full_profits):
+    ymin_profits_per_day = min(profits.tolist(), default=0)
+    ymax_profits_per_day = max(profits.tolist(), default=0)
+    ymin_total_profits = min(full_profits.tolist(), default=0)
+    ymax_total_profits = max(full_profits.tolist(), default=0)
+
+    fig = Figure(figsize=(24, 20))
+    axs = fig.subplots(2, 1)
+
+    # One scatter per subplot with a per-point colour array; points keep their original draw order
+    colors = get_hour_colors(pd.DatetimeIndex(timestamps).hour.to_numpy())
+    axs[0].scatter(timestamps, profits, color=colors)
+    axs[1].scatter(timestamps, full_profits, color=colors)
+
+    axs[0].set_xlabel('Timestamp')
+    axs[0].set_ylabel('Profits Per Day ($)')
+    axs[0].set_ylim(ymin_profits_per_day - 5, ymax_profits_per_day + 10)
+    axs[0].set_title(f'{collection_name} - Profits Per Day Electricity Included \n\n Low Value during period {ymin_profits_per_day} \n Highest Value during period {ymax_profits_per_day}')
+
+    axs[1].set_xlabel('Timestamp')
+    axs[1].set_ylabel('Profits Without Expenses ($)')
+    axs[1].set_ylim(ymin_total_profits - 5, ymax_total_profits + 10)
+    axs[1].set_title(f'{collection_name} - Total Profits Without Expenses \n\n Lowest Value during period {ymin_total_profits} \n Highest Value during period {ymax_total_profits}')
+
+    for ax in axs:
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
+        setp(ax.get_xticklabels(), rotation=60)
+
+    handles = [
+        Line2D([0], [0], marker='o', color='w', markerfacecolor=color, markersize=10, label=label)
+        for label, color in zip(hour_category_labels, hour_category_colors)
+    ]
+
+    axs[0].legend(handles=handles, title='Hour Category', bbox_to_anchor=(1, 1), loc='upper left')
+    axs[1].legend(handles=handles, title='Hour Category', bbox_to_anchor=(1, 1), loc='upper left')
+    # Enabling both grid lines:
+    axs[0].grid(which = "both")
+    axs[0].minorticks_on()
+    axs[0].tick_params(which = "minor", bottom = False, left = False)
+
+    fig.subplots_adjust(hspace=0.6)
+    fig.tight_layout()
+    return fig
+
+# Function to render and save one chart; this is the unit of work sent to the pool.
+# A work item carries only the collection name, output path and the three chart arrays.
+def render_chart_task(collection_name, output_file, timestamps, profits, full_profits):
+    start_time = time.time()
     try:
-        os.remove(zip_file_path)
-        print(f"Zip file '{zip_file_path}' has been deleted from local storage.")
-    except OSError as e:
-        print(f"Error: {zip_file_path} : {e.strerror}")
-
-# Close the MongoDB connection
-client.close()
+        fig = render_chart(collection_name, timestamps, profits, full_profits)
+
+        # Render in memory and compress straight to the output file
+        size_kb = save_compressed_figure(fig, output_file)
+        execution_time = time.time() - start_time
+        print(f"Total execution time for {collection_name}: {execution_time:.2f} seconds\n\n")
+        return {"collection": collection_name, "file": output_file, "points": len(timestamps),
+                "size_kb": round(size_kb, 1), "seconds": round(execution_time, 2), "status": "ok"}
+    except Exception as e:
+        print(f"Error processing collection {collection_name}: {e}")
+        return {"collection": collection_name, "file": output_file, "status": "failed", "error": str(e)}
+
+# Function to get the chart file path of a collection
+def get_chart_file_path(folder_path, collection_name):
+    # Sanitize collection name to use it as a file name
+    sanitized_collection_name = re.sub(r'\W+', '_', collection_name)
+    return os.path.join(folder_path, f"{sanitized_collection_name}.png")
+
+# Function to fix the headless backend as soon as a worker process starts
+def init_render_worker():
+    matplotlib.use("Agg")
+
+# Function to fetch every collection and render its chart, in this process or across a pool.
+# Returns a manifest with one entry per collection, in collection order. With an artifact cache,
+# collections whose fingerprint is unchanged reuse their previous chart and are not fetched.
+def render_charts(db, tasks, workers=1, cache=None):
+    executor = create_process_pool(workers, initializer=init_render_worker)
+    manifest = [None] * len(tasks)
+    futures = {}
+    fingerprints = {}
+    try:
+        for idx, (collection_name, output_file) in enumerate(tasks):
+            print(f"\nProcessing collection {idx + 1} out of {len(tasks)}: {collection_name}")
+            if cache is not None:
+                fingerprints[idx] = get_collection_fingerprint(db, collection_name, img_cache_variant)
+                if cache.restore(collection_name, fingerprints[idx], output_file):
+                    manifest[idx] = {"collection": collection_name, "file": output_file, "status": "ok", "cached": True}
+                    continue
+            try:
+                with get_run_report().span("fetch", collection_name) as span:
+                    chart_arrays = load_chart_data(db, collection_name)
+                    span["documents"] = len(chart_arrays[0])
+            except Exception as e:
+                print(f"Error processing collection {collection_name}: {e}")
+                manifest[idx] = {"collection": collection_name, "file": output_file, "status": "failed", "error": str(e)}
+                continue
+            if executor is None:
+                manifest[idx] = render_chart_task(collection_name, output_file, *chart_arrays)
+            else:
+                futures[idx] = executor.submit(render_chart_task, collection_name, output_file, *chart_arrays)
+
+        for idx, future in futures.items():
+            collection_name, output_file = tasks[idx]
+            try:
+                manifest[idx] = future.result()
+            except Exception as e:
+                # The worker itself died; record it and keep going
+                manifest[idx] = {"collection": collection_name, "file": output_file, "status": "failed", "error": repr(e)}
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if cache is not None:
+        for idx, entry in enumerate(manifest):
+            if entry["status"] == "ok" and not entry.get("cached"):
+                cache.store(entry["collection"], fingerprints[idx], entry["file"])
+    return manifest
+
+def main():
+    # MongoDB connection details
+    # Get the MongoDB URL from the environment variable
+    target_mongo_url = os.getenv("target_mongo_url")
+    if not target_mongo_url:
+        print("MongoDB URL not found in environment variables.")
+        exit(1)
+
+    # Connect to the MongoDB client
+    client = pymongo.MongoClient(target_mongo_url)
+    run_id = get_run_id()
+    report = start_run_report("load_img_files", run_id)
+    db = client[target_db_name]
+    print(f"Connected to MongoDB database '{target_db_name}'.")
+
+    # Get a list of collection names
+    collection_names = list_machine_collections(db)
+    total_collections = len(collection_names)
+    print(f"Total collections found: {total_collections}")
+
+    total_folders = (total_collections // collections_per_folder) + (1 if total_collections % collections_per_folder else 0)
+
+    # Assign each collection to its folder and output file
+    tasks = []
+    for folder_idx in range(total_folders):
+        folder_name = f"folder_{folder_idx + 1}"
+        output_folder = os.path.join("temp_img_files", folder_name)
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+
+        start_idx = folder_idx * collections_per_folder
+        end_idx = min(start_idx + collections_per_folder, total_collections)
+        for collection_name in collection_names[start_idx:end_idx]:
+            tasks.append((collection_name, get_chart_file_path(output_folder, collection_name)))
+
+    # Process each collection and save images to respective folders
+    cache = open_artifact_cache("img", client)
+    print(f"Rendering {len(tasks)} charts with {img_workers} worker(s).")
+    with report.span("render") as span:
+        manifest = render_charts(db, tasks, img_workers, cache)
+        span["documents"] = sum(entry.get("points", 0) for entry in manifest)
+        span["bytes"] = int(sum(entry.get("size_kb", 0) for entry in manifest) * 1024)
+    # Render timings come back in the manifest because workers do not share this run report
+    for entry in manifest:
+        if entry.get("cached"):
+            report.count("cached_collections")
+        else:
+            report.add("render", entry["collection"], seconds=entry.get("seconds", 0.0), documents=entry.get("points", 0),
+                       bytes=int(entry.get("size_kb", 0) * 1024), errors=int(entry["status"] != "ok"))
+    if cache is not None:
+        cache.close()
+        prune_directory("temp_img_files", [entry["file"] for entry in manifest if entry["status"] == "ok"])
+    failed = [entry for entry in manifest if entry["status"] != "ok"]
+    print(f"{len(manifest) - len(failed)} charts rendered, {len(failed)} failed.")
+
+    # Pack the charts, in collection order, into size-bounded archives and stream them into MongoDB
+    zip_db = client['zip_files']
+    with report.span("compress_upload") as span:
+        archives = build_archives(zip_db, 'img_files', [entry["file"] for entry in manifest if entry["status"] == "ok"], run_id)
+        span["bytes"] = sum(archive.size for archive in archives)
+
+    # Only drop the previous archives once the new ones are fully uploaded
+    delete_old_archives(zip_db, 'img_files', keep_run_id=run_id)
+    report.finish(zip_db)
+
+    # Close the MongoDB connection
+    client.close()
+
+if __name__ == "__main__":
+    main()
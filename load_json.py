@@ -1,17 +1,20 @@
+from bson import ObjectId
 from pymongo import MongoClient
-import json
-from bson import json_util
 import os
+import sys
+from bulk_writer import write_collections, insert_batch
+from mongo_reader import STAGING_PREFIX, find_documents
+from run_report import start_run_report
+from rollups import backfill_rollups, find_rollup_fields, fold_documents, rollup_db_name, update_rollups
 
 # Function to load documents from MongoDB
-def load_documents_from_mongo(mongo_url, db_name, collection_name):
+def load_documents_from_mongo(mongo_url, db_name, collection_name, query=None, sort=None):
     client = MongoClient(mongo_url)
     db = client[db_name]
-    collection = db[collection_name]
-    documents = collection.find()
-    json_documents = [json.loads(json_util.dumps(doc)) for doc in documents]
+    # Only the fields the transform uses; dates are converted while decoding
+    documents = list(find_documents(db, collection_name, "source", query=query, sort=sort))
     print("Documents loaded from MongoDB")
-    return json_documents
+    return documents
 
 # Function to calculate electricity bill
 def calculate_electricity_bill(power_consumption_watts):
@@ -40,72 +43,513 @@ def clear_database(client, db_name):
     client.drop_database(db_name)
     print(f"Database {db_name} cleared.")
 
+# Function to list the staged collections of a database
+def list_staged_collections(db):
+    return [name for name in db.list_collection_names() if name.startswith(STAGING_PREFIX)]
+
+# Function to drop the staged collections, including those orphaned by a failed rebuild
+def clear_staging(client):
+    for name in (target_db_name, rollup_db_name):
+        orphans = list_staged_collections(client[name])
+        if orphans:
+            print(f"Dropping {len(orphans)} leftover staging collection(s) from {name}.")
+        for orphan in orphans:
+            client[name].drop_collection(orphan)
+
+# Function to prepare a full rebuild and get the prefix of the collections it writes: fresh staged
+# collections next to the live ones (publish_mode=swap) or the cleared live databases (publish_mode=drop)
+def begin_rebuild(client):
+    if publish_mode == "swap":
+        clear_staging(client)
+        return STAGING_PREFIX
+    clear_database(client, target_db_name)
+    clear_database(client, rollup_db_name)
+    clear_watermarks(client)
+    return ""
+
+# Function to create the live collection's secondary indexes on its staging replacement
+def copy_indexes(live_collection, staging_collection):
+    for index_name, info in live_collection.index_information().items():
+        if index_name == "_id_":
+            continue
+        options = {key: value for key, value in info.items() if key not in ("key", "v", "ns")}
+        staging_collection.create_index(info["key"], name=index_name, **options)
+
+# Function to swap every staged collection of a database over its live collection. Indexes are built
+# on the staged collection first, then it is renamed over the live one (dropTarget). Staging lives in
+# the same database, so each rename only changes metadata and readers see either the old or the new
+# collection, never a partial one. Live collections missing from staging are dropped.
+def swap_database(db):
+    staged_names = list_staged_collections(db)
+    live_names = set(db.list_collection_names()) - set(staged_names)
+    published = [name[len(STAGING_PREFIX):] for name in staged_names]
+    for staged_name, name in zip(staged_names, published):
+        if name in live_names:
+            copy_indexes(db[name], db[staged_name])
+    for staged_name, name in zip(staged_names, published):
+        db[staged_name].rename(name, dropTarget=True)
+    for name in live_names - set(published):
+        db.drop_collection(name)
+    print(f"Published {len(published)} rebuilt collection(s) into {db.name}.")
+
+# Function to swap a finished rebuild (machine collections and rollups) into the live collections
+def publish_staging(client):
+    # Without watermarks a crash during the swap just means a full rebuild next run
+    clear_watermarks(client)
+    swap_database(client[target_db_name])
+    swap_database(client[rollup_db_name])
+
+# Function to load the per-machine watermarks (highest source _id already processed)
+def load_watermarks(client):
+    state_collection = client[sync_state_db_name][sync_state_collection_name]
+    return {doc["_id"]: doc["last_id"] for doc in state_collection.find()}
+
+# Function to advance the per-machine watermarks after a successful insert
+def save_watermarks(client, watermarks):
+    state_collection = client[sync_state_db_name][sync_state_collection_name]
+    for name, last_id in watermarks.items():
+        # $max keeps the watermark monotonic even if an older run finishes late
+        state_collection.update_one({"_id": name}, {"$max": {"last_id": last_id}}, upsert=True)
+
+# Function to build the incremental source query: each known machine from its own watermark, and
+# machines not seen yet from the highest watermark (the source is append-only, so their older
+# documents were already read by an earlier run). A machine that stops reporting does not hold
+# the next runs back to its frozen watermark.
+def build_incremental_query(watermarks):
+    clauses = [{"name": name, "_id": {"$gt": last_id}} for name, last_id in watermarks.items()]
+    clauses.append({"name": {"$nin": list(watermarks)}, "_id": {"$gt": max(watermarks.values())}})
+    return {"$or": clauses}
+
+# Lowest possible watermark: a machine saved with it is read from its very first document
+MIN_WATERMARK = ObjectId("0" * 24)
+
+# Function to clear the stored watermarks so the next run starts from scratch
+def clear_watermarks(client):
+    client[sync_state_db_name][sync_state_collection_name].delete_many({})
+    print("Sync watermarks cleared.")
+
+# Sync state lives outside channel_related_json so the exporters never see it as a machine collection
+sync_state_db_name = "sync_state"
+sync_state_collection_name = "load_json_watermarks"
+
+# Pass --full-rebuild (or set full_rebuild=1) to drop the target database and reload everything,
+# e.g. after the transform below changes
+full_rebuild = "--full-rebuild" in sys.argv or os.getenv("full_rebuild") == "1"
+
+# "python" formats one document at a time; "vectorized" runs the same math on whole columns (needs pandas);
+# "aggregation" runs it inside MongoDB with an aggregation pipeline
+transform_engine = os.getenv("transform_engine", "python")
+
+# Function to format source documents one at a time and group them by machine name.
+# Each formatted document keeps its source _id, so writing the same source document twice (a
+# machine retried after a partly failed run) is a duplicate-key error instead of a second copy.
+def format_documents(data):
+    grouped_data = {}
+    for item in data:
+        name = item["name"]
+        if name not in grouped_data:
+            grouped_data[name] = []
+        profits_per_day = convert_profits_to_number(item["rentability"])
+        electricity_bill_per_day = calculate_electricity_bill(int(item["power_consumption"].replace("W", "")))
+        electricity_units = calculate_electricity_units(int(item["power_consumption"].replace("W", "")))
+        formatted_item = {
+            "_id": item["_id"],
+            "Timestamp": item["updated_timestamp"],
+            "Name": item["name"],
+            "Model Version": item["date"],
+            "Hashrate": item["hash_rate"],
+            "Power Consumption": item["power_consumption"],
+            "Noise Level": item["noise_level"],
+            "Algorithm": item["algorithm"],
+            "Profits Per Day ($)": profits_per_day,
+            "Electricity Units Per Day (kw)": round(electricity_units * 24, 4),
+            "Electricity Bill Per Day ($)": electricity_bill_per_day,
+            "Profits Without Expenses ($)":( profits_per_day + electricity_bill_per_day ) if profits_per_day is not None else None,
+            "Profits Per Month ($)": profits_per_day * 30 if profits_per_day is not None else None,
+            "Electricity Units Per Month (kw)": round(electricity_units * 24 * 30, 4),
+            "Electricity Bill Per Month ($)": electricity_bill_per_day * 30,
+            "Monthly Profits Without Expenses ($)": ( (profits_per_day * 30) + (30 * electricity_bill_per_day) ) if profits_per_day is not None else None
+        }
+        grouped_data[name].append(formatted_item)
+    return grouped_data
+
+# Function to format source documents column-wise and group them by machine name in one pass.
+# Produces exactly the same documents as format_documents.
+def format_documents_vectorized(data):
+    import numpy as np
+    import pandas as pd
+
+    if not data:
+        return {}
+
+    source_columns = ["updated_timestamp", "name", "date", "hash_rate", "power_consumption",
+                      "noise_level", "algorithm", "rentability"]
+    df = pd.DataFrame.from_records(data, columns=source_columns)
+
+    # Profits: same string clean-up as convert_profits_to_number, applied to the whole column.
+    # Casting the object array to float calls float() per value, so parsing matches exactly.
+    profits_str = (df["rentability"].str.replace("$", "", regex=False)
+                   .str.replace("/day", "", regex=False)
+                   .str.replace(",", "", regex=False)
+                   .str.strip())
+    unknown = (profits_str.str.lower() == "unknown").to_numpy()
+    is_negative = profits_str.str.startswith("-").fillna(False).to_numpy(dtype=bool)
+    digits = profits_str.str.replace("-", "", regex=False).to_numpy(dtype=object)
+    digits[unknown] = "nan"
+    profits = digits.astype(np.float64)
+    profits = np.where(is_negative, -profits, profits)
+
+    # Power consumption only takes a handful of distinct values, so the rounded figures are
+    # computed once per distinct wattage with the scalar helpers (identical rounding) and broadcast.
+    power_codes, power_values = pd.factorize(df["power_consumption"])
+    watts = [int(value.replace("W", "")) for value in power_values]
+    bill_per_day = np.array([calculate_electricity_bill(w) for w in watts], dtype=np.float64)[power_codes]
+    units_per_day = np.array([round(calculate_electricity_units(w) * 24, 4) for w in watts], dtype=np.float64)[power_codes]
+    units_per_month = np.array([round(calculate_electricity_units(w) * 24 * 30, 4) for w in watts], dtype=np.float64)[power_codes]
+
+    profits_without_expenses = profits + bill_per_day
+    profits_per_month = profits * 30
+    bill_per_month = bill_per_day * 30
+    monthly_profits_without_expenses = (profits * 30) + (30 * bill_per_day)
+
+    # Back to Python scalars, with None wherever the rentability was "unknown"
+    def to_list(values, missing=None):
+        values = values.tolist()
+        if missing is not None and missing.any():
+            for i in np.flatnonzero(missing):
+                values[i] = None
+        return values
+
+    # Pass-through fields are taken straight from the documents: a pandas column would turn
+    # e.g. a numeric hash_rate next to None into 5.0 and NaN
+    def passthrough(field):
+        return [item[field] for item in data]
+
+    columns = [
+        ("_id", passthrough("_id")),
+        ("Timestamp", passthrough("updated_timestamp")),
+        ("Name", passthrough("name")),
+        ("Model Version", passthrough("date")),
+        ("Hashrate", passthrough("hash_rate")),
+        ("Power Consumption", passthrough("power_consumption")),
+        ("Noise Level", passthrough("noise_level")),
+        ("Algorithm", passthrough("algorithm")),
+        ("Profits Per Day ($)", to_list(profits, unknown)),
+        ("Electricity Units Per Day (kw)", to_list(units_per_day)),
+        ("Electricity Bill Per Day ($)", to_list(bill_per_day)),
+        ("Profits Without Expenses ($)", to_list(profits_without_expenses, unknown)),
+        ("Profits Per Month ($)", to_list(profits_per_month, unknown)),
+        ("Electricity Units Per Month (kw)", to_list(units_per_month)),
+        ("Electricity Bill Per Month ($)", to_list(bill_per_month)),
+        ("Monthly Profits Without Expenses ($)", to_list(monthly_profits_without_expenses, unknown)),
+    ]
+    keys = [key for key, _ in columns]
+    records = [dict(zip(keys, row)) for row in zip(*(values for _, values in columns))]
+
+    # Group by name in one pass: a stable sort on the factorized names keeps both the
+    # first-seen machine order and the document order inside each machine
+    name_codes, names = pd.factorize(df["name"])
+    order = np.argsort(name_codes, kind="stable")
+    bounds = np.cumsum(np.bincount(name_codes, minlength=len(names)))
+    grouped_data = {}
+    start = 0
+    for code, name in enumerate(names):
+        end = bounds[code]
+        grouped_data[name] = [records[i] for i in order[start:end]]
+        start = end
+    return grouped_data
+
+# Function to build the aggregation stages that reproduce format_documents on the server.
+# The rounded electricity figures depend only on the wattage string, so they are computed here
+# with the same Python helpers for each distinct wattage and embedded as literals; everything
+# else (profit parsing, "unknown" -> null, the per-document arithmetic) runs in the pipeline.
+def build_format_pipeline(power_values):
+    branches = []
+    for power_consumption in power_values:
+        watts = int(power_consumption.replace("W", ""))
+        electricity_bill_per_day = calculate_electricity_bill(watts)
+        electricity_units = calculate_electricity_units(watts)
+        branches.append({
+            "case": {"$eq": ["$power_consumption", power_consumption]},
+            "then": {"$literal": {
+                "bill": electricity_bill_per_day,
+                "units_day": round(electricity_units * 24, 4),
+                "units_month": round(electricity_units * 24 * 30, 4),
+                "bill_month": electricity_bill_per_day * 30
+            }}
+        })
+
+    def strip_chars(expression, *chars):
+        for char in chars:
+            expression = {"$replaceAll": {"input": expression, "find": {"$literal": char}, "replacement": ""}}
+        return expression
+
+    def unless_unknown(expression):
+        return {"$cond": ["$_unknown", None, expression]}
+
+    return [
+        {"$addFields": {
+            "_profits_str": {"$trim": {"input": strip_chars("$rentability", "$", "/day", ",")}},
+            "_power": {"$switch": {"branches": branches, "default": None}} if branches else None
+        }},
+        {"$addFields": {
+            "_unknown": {"$eq": [{"$toLower": "$_profits_str"}, "unknown"]},
+            "_negative": {"$eq": [{"$substrCP": ["$_profits_str", 0, 1]}, "-"]}
+        }},
+        {"$addFields": {
+            "_profits": unless_unknown({"$let": {
+                "vars": {"number": {"$toDouble": {"$trim": {"input": strip_chars("$_profits_str", "-")}}}},
+                "in": {"$cond": ["$_negative", {"$multiply": ["$$number", -1]}, "$$number"]}
+            }})
+        }},
+        {"$project": {
+            # The source _id is kept, like format_documents
+            "_id": 1,
+            "Timestamp": "$updated_timestamp",
+            "Name": "$name",
+            "Model Version": "$date",
+            "Hashrate": "$hash_rate",
+            "Power Consumption": "$power_consumption",
+            "Noise Level": "$noise_level",
+            "Algorithm": "$algorithm",
+            "Profits Per Day ($)": "$_profits",
+            "Electricity Units Per Day (kw)": "$_power.units_day",
+            "Electricity Bill Per Day ($)": "$_power.bill",
+            "Profits Without Expenses ($)": unless_unknown({"$add": ["$_profits", "$_power.bill"]}),
+            "Profits Per Month ($)": unless_unknown({"$multiply": ["$_profits", 30]}),
+            "Electricity Units Per Month (kw)": "$_power.units_month",
+            "Electricity Bill Per Month ($)": "$_power.bill_month",
+            "Monthly Profits Without Expenses ($)": unless_unknown(
+                {"$add": [{"$multiply": ["$_profits", 30]}, {"$multiply": [30, "$_power.bill"]}]})
+        }}
+    ]
+
+# Function to format and group new source documents with the aggregation framework.
+# With merge_on_server (source and target on the same cluster) each machine's documents are
+# written by $merge and never leave the server; otherwise the formatted documents are streamed
+# from the source and inserted into the target. Returns the new per-machine watermarks.
+def sync_with_aggregation(source_collection, target_db, watermarks, merge_on_server, batch_size=1000,
+                          collection_prefix=""):
+    format_stages = build_format_pipeline(source_collection.distinct("power_consumption"))
+
+    # Same selection as the Python path: per machine only what is above that machine's own watermark
+    base_query = build_incremental_query(watermarks) if watermarks else {}
+    machines = list(source_collection.aggregate([
+        {"$match": base_query},
+        {"$group": {"_id": "$name", "last_id": {"$max": "$_id"}}}
+    ], allowDiskUse=True))
+
+    new_watermarks = {}
+    total_collections = len(machines)
+    for index, machine in enumerate(machines, start=1):
+        machine_name = machine["_id"]
+        target_name = collection_prefix + machine_name
+        if machine_name in watermarks and machine["last_id"] <= watermarks[machine_name]:
+            continue
+        # Capped at the last_id recorded as the new watermark: documents written after the $group above
+        # are left for the next run instead of being written now and read again then
+        machine_query = {"name": machine_name, "_id": {"$lte": machine["last_id"]}}
+        if watermarks:
+            machine_query["_id"]["$gt"] = watermarks.get(machine_name, max(watermarks.values()))
+        pipeline = [{"$match": machine_query}, {"$sort": {"_id": 1}}] + format_stages
+
+        if merge_on_server:
+            pipeline.append({"$merge": {
+                "into": {"db": target_db.name, "coll": target_name},
+                # Documents already written by an earlier, partly failed run are left as they are
+                "whenMatched": "keepExisting",
+                "whenNotMatched": "insert"
+            }})
+            source_collection.aggregate(pipeline, allowDiskUse=True)
+            print(f"Merged new documents into collection {machine_name} on the server ({index}/{total_collections})")
+        else:
+            inserted = 0
+            batch = []
+            for formatted_item in source_collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+                batch.append(formatted_item)
+                if len(batch) >= batch_size:
+                    insert_batch(target_db[target_name], batch)
+                    inserted += len(batch)
+                    batch = []
+            if batch:
+                insert_batch(target_db[target_name], batch)
+                inserted += len(batch)
+            print(f"Inserted {inserted} documents into collection {machine_name} ({index}/{total_collections})")
+        new_watermarks[machine_name] = machine["last_id"]
+    return new_watermarks
+
+# Function to fold the documents the aggregation engine just wrote into the rollups. They never pass
+# through Python, so they are read back by their source _id, the same range sync_with_aggregation wrote.
+def fold_aggregated_documents(target_db, rollup_db, watermarks, new_watermarks, collection_prefix=""):
+    for machine_name, last_id in new_watermarks.items():
+        id_range = {"$lte": last_id}
+        if watermarks:
+            id_range["$gt"] = watermarks.get(machine_name, max(watermarks.values()))
+        fold_documents(rollup_db, machine_name,
+                       find_rollup_fields(target_db[collection_prefix + machine_name], {"_id": id_range}), collection_prefix)
+
+# Function to fold newly inserted documents into the rollups and repair machines they do not cover.
+# Failed machines are folded in when they are retried.
+def fold_into_rollups(target_db, rollup_db, grouped_data, failed, collection_prefix=""):
+    update_rollups(rollup_db, {machine_name: documents for machine_name, documents in grouped_data.items()
+                               if machine_name not in failed}, collection_prefix)
+    backfill_rollups(target_db, rollup_db, collection_prefix, skip_machines=failed)
+
 # Load MongoDB connection details from environment variables
 load_mongo_url = os.getenv("load_mongo_url")
 db_name = "mydatabase"
 collection_name = "asinc_profits"
 
-# Load data from the source MongoDB database
-data = load_documents_from_mongo(load_mongo_url, db_name, collection_name)
-
-# Format the data
-formatted_data = []
-grouped_data = {}
-for item in data:
-    name = item["name"]
-    if name not in grouped_data:
-        grouped_data[name] = []
-    profits_per_day = convert_profits_to_number(item["rentability"])
-    electricity_bill_per_day = calculate_electricity_bill(int(item["power_consumption"].replace("W", "")))
-    electricity_units = calculate_electricity_units(int(item["power_consumption"].replace("W", "")))
-    formatted_item = {
-        "Timestamp": item["updated_timestamp"],
-        "Name": item["name"],
-        "Model Version": item["date"],
-        "Hashrate": item["hash_rate"],
-        "Power Consumption": item["power_consumption"],
-        "Noise Level": item["noise_level"],
-        "Algorithm": item["algorithm"],
-        "Profits Per Day ($)": profits_per_day,
-        "Electricity Units Per Day (kw)": round(electricity_units * 24, 4),
-        "Electricity Bill Per Day ($)": electricity_bill_per_day,
-        "Profits Without Expenses ($)":( profits_per_day + electricity_bill_per_day ) if profits_per_day is not None else None,
-        "Profits Per Month ($)": profits_per_day * 30 if profits_per_day is not None else None,
-        "Electricity Units Per Month (kw)": round(electricity_units * 24 * 30, 4),
-        "Electricity Bill Per Month ($)": electricity_bill_per_day * 30,
-        "Monthly Profits Without Expenses ($)": ( (profits_per_day * 30) + (30 * electricity_bill_per_day) ) if profits_per_day is not None else None
-    }
-    grouped_data[name].append(formatted_item)
-
-for name, details in grouped_data.items():
-    machine_entry = {
-        "Machine Name": name,
-        "Machine Data": details
-    }
-    formatted_data.append(machine_entry)
-
-data = formatted_data
-
 # Load target MongoDB connection details from environment variables
 target_mongo_url = os.getenv("target_mongo_url")
 target_db_name = "channel_related_json"
 
-# Connect to the target MongoDB server
-target_client = MongoClient(target_mongo_url)
+# publish_mode=swap (default) rebuilds into "_staging."-prefixed collections of the live databases and
+# renames them over the live ones at the end; publish_mode=drop drops the live databases first and
+# inserts in place
+publish_mode = os.getenv("publish_mode", "swap")
+
+# Keep the hourly/daily/monthly rollups in rollup_db_name up to date. Machines whose rollups do not
+# cover their whole collection (e.g. rollups enabled on a database that was already syncing) get
+# theirs rebuilt from the raw collection.
+maintain_rollups = os.getenv("maintain_rollups", "1") == "1"
+
+# Batch size and number of concurrent insert threads (default: the client's connection pool size)
+insert_batch_size = int(os.getenv("insert_batch_size", "1000"))
+insert_workers = int(os.getenv("insert_workers", "0")) or None
+
+# For transform_engine=aggregation: write with $merge on the server. Only possible when the source
+# and target databases live on the same cluster, which is assumed when both URLs are equal.
+aggregation_merge = os.getenv("aggregation_merge", "1" if load_mongo_url == target_mongo_url else "0") == "1"
+
+def main():
+    # Connect to the target MongoDB server
+    target_client = MongoClient(target_mongo_url)
+    report = start_run_report("load_json")
+
+    # Decide between an incremental sync and a full rebuild
+    watermarks = {} if full_rebuild else load_watermarks(target_client)
+    rebuild = full_rebuild or not watermarks
+
+    if transform_engine == "aggregation":
+        # Parsing, arithmetic and grouping run inside MongoDB
+        collection_prefix = ""
+        if rebuild:
+            print("Running full rebuild with the aggregation engine.")
+            collection_prefix = begin_rebuild(target_client)
+        source_client = MongoClient(load_mongo_url)
+        with report.span("transform"):
+            new_watermarks = sync_with_aggregation(source_client[db_name][collection_name],
+                                                   target_client[target_db_name], watermarks, aggregation_merge,
+                                                   collection_prefix=collection_prefix)
+        swap_rebuild = rebuild and publish_mode == "swap"
+        # Staged rollups are folded before the swap; live ones only once the watermarks are saved
+        # (see main below)
+        if maintain_rollups and swap_rebuild:
+            with report.span("rollup"):
+                fold_aggregated_documents(target_client[target_db_name], target_client[rollup_db_name],
+                                          watermarks, new_watermarks, collection_prefix)
+                backfill_rollups(target_client[target_db_name], target_client[rollup_db_name], collection_prefix)
+        if swap_rebuild:
+            with report.span("publish"):
+                publish_staging(target_client)
+        save_watermarks(target_client, new_watermarks)
+        if maintain_rollups and not swap_rebuild:
+            with report.span("rollup"):
+                fold_aggregated_documents(target_client[target_db_name], target_client[rollup_db_name],
+                                          watermarks, new_watermarks, collection_prefix)
+                backfill_rollups(target_client[target_db_name], target_client[rollup_db_name], collection_prefix)
+        report.count("machines", len(new_watermarks))
+        report.finish(target_client['zip_files'])
+        print("All data inserted into MongoDB collections successfully!")
+        return
+
+    with report.span("fetch") as span:
+        if rebuild:
+            print("Running full rebuild.")
+            data = load_documents_from_mongo(load_mongo_url, db_name, collection_name)
+        else:
+            # Only what lies above each machine's own watermark is read
+            print(f"Running incremental sync ({len(watermarks)} machines tracked).")
+            data = load_documents_from_mongo(load_mongo_url, db_name, collection_name,
+                                             query=build_incremental_query(watermarks), sort=[("_id", 1)])
+        span["documents"] = len(data)
+
+    # Drop documents each machine has already processed and track the new high-water marks
+    new_watermarks = {}
+    pending_data = []
+    for item in data:
+        item_id = item["_id"]
+        name = item["name"]
+        if name in watermarks and item_id <= watermarks[name]:
+            continue
+        if name not in new_watermarks or item_id > new_watermarks[name]:
+            new_watermarks[name] = item_id
+        pending_data.append(item)
+    data = pending_data
+    print(f"{len(data)} new documents to process.")
+
+    # Format the data
+    with report.span("transform") as span:
+        if transform_engine == "vectorized":
+            grouped_data = format_documents_vectorized(data)
+        else:
+            grouped_data = format_documents(data)
+        span["documents"] = len(data)
+
+    # A rebuild writes into fresh staged collections (or the cleared live ones with publish_mode=drop)
+    collection_prefix = begin_rebuild(target_client) if rebuild else ""
+    target_db, rollup_db = target_client[target_db_name], target_client[rollup_db_name]
+
+    # Insert data into the target database: fixed-size unordered batches, written concurrently
+    with report.span("upload") as span:
+        summary = write_collections(target_db, {collection_prefix + machine_name: documents
+                                                for machine_name, documents in grouped_data.items()},
+                                    batch_size=insert_batch_size, workers=insert_workers)
+        span["documents"] = summary["documents"]
+    summary["failed"] = {name[len(collection_prefix):]: error for name, error in summary["failed"].items()}
+    report.count("machines", len(grouped_data))
+    report.count("failed_machines", len(summary["failed"]))
+
+    # Machines whose insert failed keep their old watermark and are retried next run; their batches
+    # that did get in come back as duplicate keys (same source _id) and are not written twice.
+    # A failed machine without a watermark gets the bound its documents were read from, otherwise
+    # the next run would only read it from above the other machines' new watermarks.
+    for machine_name in summary["failed"]:
+        if machine_name in watermarks:
+            new_watermarks.pop(machine_name, None)
+        else:
+            new_watermarks[machine_name] = max(watermarks.values()) if watermarks else MIN_WATERMARK
+
+    swap_rebuild = rebuild and publish_mode == "swap"
+    if swap_rebuild and summary["failed"]:
+        # Nothing is published: the live databases and the watermarks stay as they were
+        print("Rebuild incomplete; the live database was left untouched.")
+        clear_staging(target_client)
+        new_watermarks = {}
+    elif swap_rebuild:
+        # The staged rollups are built before the swap and published with the machine collections
+        if maintain_rollups:
+            with report.span("rollup"):
+                fold_into_rollups(target_db, rollup_db, grouped_data, summary["failed"], collection_prefix)
+        with report.span("publish"):
+            publish_staging(target_client)
 
-# Clear the target database
-clear_database(target_client, target_db_name)
+    # Record the watermarks only after the inserts succeeded
+    save_watermarks(target_client, new_watermarks)
 
-# Get the target database
-target_db = target_client[target_db_name]
+    # Live rollups are folded only after the watermarks are saved: a crash during the fold then leaves
+    # their coverage below the raw count, which backfill_rollups repairs, instead of replaying the
+    # same documents into the $inc totals next run
+    if maintain_rollups and not swap_rebuild:
+        with report.span("rollup"):
+            fold_into_rollups(target_db, rollup_db, grouped_data, summary["failed"], collection_prefix)
+    report.finish(target_client['zip_files'])
 
-# Insert data into the target database
-total_collections = len(data)
-for index, machine_entry in enumerate(data, start=1):
-    machine_name = machine_entry["Machine Name"]
-    machine_data = machine_entry["Machine Data"]
-    collection = target_db[machine_name]
-    collection.insert_many(machine_data)
-    print(f"Inserted {len(machine_data)} documents into collection {machine_name} ({index}/{total_collections})")
+    if summary["failed"]:
+        print(f"Failed to insert data for {len(summary['failed'])} collection(s).")
+        sys.exit(1)
+    print("All data inserted into MongoDB collections successfully!")
 
-print("All data inserted into MongoDB collections successfully!")
+if __name__ == "__main__":
+    main()
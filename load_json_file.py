@@ -1,92 +1,135 @@
 import pymongo
+import io
 import json
 import os
 import re
-import shutil  # For removing directories and their contents
-from bson import ObjectId
+import tempfile
 import zipfile  # For creating zip files
+from archive_store import GridFSArchiveSink, archive_deflate_level, delete_old_archives, get_run_id
+from artifact_cache import open_artifact_cache, get_collection_fingerprint
+from mongo_reader import find_documents, list_machine_collections
+from run_report import start_run_report
 
 # Replace these values with your target MongoDB connection details
 target_mongo_url = os.getenv("target_mongo_url")
 target_db_name = "channel_related_json"
 
-# Connect to MongoDB
-client = pymongo.MongoClient(target_mongo_url)
-db = client[target_db_name]
+# Pretty-printing roughly doubles the bytes we compress; set json_indent=0 for compact output
+json_indent = int(os.getenv("json_indent", "4")) or None
 
-# Function to convert ObjectId fields to string representation
-def convert_object_ids(doc):
-    for key in doc:
-        if isinstance(doc[key], ObjectId):
-            doc[key] = str(doc[key])
-    return doc
+# Bump when the JSON content changes, so cached files are regenerated
+json_cache_variant = f"json-1:indent={json_indent}"
 
 # Function to sanitize collection name for file naming
 def sanitize_collection_name(collection_name):
     return re.sub(r'[^\w\-_\.]', '_', collection_name)
 
-# Ensure the json_files directory exists
-if os.path.exists('json_files'):
-    print("Directory 'json_files' exists. Deleting it completely.")
-    # Remove the directory and all its contents
-    shutil.rmtree('json_files')
-    print("Directory 'json_files' and its contents have been deleted.")
-
-# Create the json_files directory
-os.makedirs('json_files')
-
-# Fetch all collections and save each as a JSON file
-collection_names = db.list_collection_names()
-total_collections = len(collection_names)
-for index, collection_name in enumerate(collection_names, start=1):
-    collection = db[collection_name]
-    documents = collection.find()
-    documents_list = [convert_object_ids(doc) for doc in documents]
-
-    # Sanitize collection name for file naming
-    sanitized_collection_name = sanitize_collection_name(collection_name)
-
-    # Define the output file path
-    file_path = os.path.join('json_files', f'{sanitized_collection_name}.json')
-
-    # Save the documents to the JSON file
-    with open(file_path, 'w') as json_file:
-        json.dump(documents_list, json_file, indent=4)
-
-    print(f"Data saved to {file_path} successfully. ({index} out of {total_collections} files)")
-
-# Zip the json_files directory
-zip_file_path = 'json_files.zip'
-with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-    for root, dirs, files in os.walk('json_files'):
-        for file in files:
-            file_path = os.path.join(root, file)
-            arcname = os.path.relpath(file_path, 'json_files')
-            zipf.write(file_path, arcname)
-
-print(f"Directory 'json_files' has been zipped into '{zip_file_path}'.")
-
-# Connect to the target MongoDB database for storing the zip file
-zip_db = client['zip_files']
-zip_collection = zip_db['json_files']
-
-# Check if the collection is not empty and delete its contents if it is not empty
-if zip_collection.count_documents({}) > 0:
-    print("Collection 'json_files' is not empty. Deleting all documents.")
-    zip_collection.delete_many({})
-    print("All documents in 'json_files' collection have been deleted.")
-
-# Read the zip file and insert it into MongoDB
-with open(zip_file_path, 'rb') as file_data:
-    zip_binary = file_data.read()
-    zip_document = {
-        "filename": "json_files.zip",
-        "filedata": zip_binary
-    }
-    zip_collection.insert_one(zip_document)
-
-print("Zip file has been saved to MongoDB successfully.")
-
-
-# Close the MongoDB connection
-client.close()
+# Function to stream a cursor into an open zip archive as one JSON array, one document at a time.
+# Documents must come from mongo_reader's "json" consumer, which already decodes ObjectIds to strings.
+# With indent=4 the bytes are identical to json.dump(documents_list, f, indent=4).
+# copy_to, if given, is a text file that receives the same JSON (used to fill the artifact cache).
+def write_documents_to_zip(zipf, arcname, documents, indent=None, copy_to=None):
+    # force_zip64 because the entry size is not known up front
+    with zipf.open(arcname, 'w', force_zip64=True) as raw_entry:
+        entry = io.TextIOWrapper(raw_entry, encoding='utf-8')
+
+        def emit(text):
+            entry.write(text)
+            if copy_to is not None:
+                copy_to.write(text)
+
+        count = 0
+        for doc in documents:
+            doc_json = json.dumps(doc, indent=indent)
+            if indent is None:
+                emit(("[" if count == 0 else ", ") + doc_json)
+            else:
+                padding = " " * indent
+                doc_json = padding + doc_json.replace("\n", "\n" + padding)
+                emit(("[\n" if count == 0 else ",\n") + doc_json)
+            count += 1
+        if count == 0:
+            emit("[]")
+        else:
+            emit("]" if indent is None else "\n]")
+        entry.flush()
+        entry.detach()
+    return count
+
+# Function to add a collection's cached JSON file to the archive when its fingerprint is unchanged
+def restore_cached_json(zipf, arcname, collection_name, fingerprint, cache, staging_dir):
+    staged_path = os.path.join(staging_dir, arcname)
+    if not cache.restore(collection_name, fingerprint, staged_path):
+        return False
+    zipf.write(staged_path, arcname)
+    os.remove(staged_path)
+    return True
+
+# Function to stream documents into the archive and record the resulting file in the cache
+def write_documents_to_zip_and_cache(zipf, arcname, documents, collection_name, fingerprint, cache, staging_dir):
+    staged_path = os.path.join(staging_dir, arcname)
+    with open(staged_path, 'w', encoding='utf-8') as copy_to:
+        count = write_documents_to_zip(zipf, arcname, documents, indent=json_indent, copy_to=copy_to)
+    cache.store(collection_name, fingerprint, staged_path)
+    os.remove(staged_path)
+    return count
+
+def main():
+    # Connect to MongoDB
+    client = pymongo.MongoClient(target_mongo_url)
+    db = client[target_db_name]
+
+    # Connect to the target MongoDB database for storing the zip file
+    zip_db = client['zip_files']
+    run_id = get_run_id()
+    report = start_run_report("load_json_file", run_id)
+
+    # Unchanged collections reuse their cached JSON file instead of being fetched again
+    cache = open_artifact_cache("json", client)
+    staging_dir = tempfile.mkdtemp()
+
+    # Stream every collection straight into the zip archive, which itself streams into GridFS
+    zip_file_name = 'json_files.zip'
+    collection_names = list_machine_collections(db)
+    total_collections = len(collection_names)
+    # Fetching, encoding, compressing and uploading are interleaved, so each collection is timed as one "encode" span
+    with report.span("export") as export_span, GridFSArchiveSink(zip_db, 'json_files', zip_file_name, run_id) as sink:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, compresslevel=archive_deflate_level) as zipf:
+            for index, collection_name in enumerate(collection_names, start=1):
+                # Sanitize collection name for file naming
+                sanitized_collection_name = sanitize_collection_name(collection_name)
+                arcname = f'{sanitized_collection_name}.json'
+
+                with report.span("encode", collection_name) as span:
+                    if cache is None:
+                        document_count = write_documents_to_zip(zipf, arcname, find_documents(db, collection_name, "json"), indent=json_indent)
+                    else:
+                        fingerprint = get_collection_fingerprint(db, collection_name, json_cache_variant)
+                        if restore_cached_json(zipf, arcname, collection_name, fingerprint, cache, staging_dir):
+                            report.count("cached_collections")
+                            print(f"Reused cached {arcname}. ({index} out of {total_collections} files)")
+                            continue
+                        document_count = write_documents_to_zip_and_cache(zipf, arcname, find_documents(db, collection_name, "json"), collection_name,
+                                                                          fingerprint, cache, staging_dir)
+                    span["documents"] = document_count
+                    export_span["documents"] += document_count
+
+                print(f"Data saved to {arcname} ({document_count} documents) successfully. ({index} out of {total_collections} files)")
+
+        export_span["bytes"] = sink.size
+
+    os.rmdir(staging_dir)
+    if cache is not None:
+        cache.close()
+
+    print("Zip file has been saved to MongoDB successfully.")
+
+    # Only drop the previous archive once the new one is fully uploaded
+    delete_old_archives(zip_db, 'json_files', keep_run_id=run_id)
+    report.finish(zip_db)
+
+    # Close the MongoDB connection
+    client.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import pymongo
+import mmap
+import os
+import struct
+import tempfile
+import zipfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from archive_store import GridFSArchiveSink, delete_old_archives, download_archive, get_run_id
+from artifact_cache import open_artifact_cache, get_collection_fingerprint
+from load_json_file import sanitize_collection_name
+from mongo_reader import find_documents, list_machine_collections
+from run_report import start_run_report
+from timestamp_utils import parse_timestamp_column
+
+# Columnar export: every machine collection becomes one typed, compressed Parquet (or Arrow IPC)
+# file inside parquet_files.zip, archived in GridFS next to json_files.zip.
+# Entries are stored uncompressed in the zip (the files are already compressed), so the loader
+# below can memory-map the downloaded archive and read every table in place.
+
+# Replace these values with your target MongoDB connection details
+target_mongo_url = os.getenv("target_mongo_url")
+target_db_name = "channel_related_json"
+
+# columnar_format=parquet (smallest archive) or arrow (Arrow IPC file, zero-copy reads when uncompressed)
+columnar_format = os.getenv("columnar_format", "parquet")
+# Parquet codec: zstd, snappy, gzip, brotli, lz4 or none
+parquet_compression = os.getenv("parquet_compression", "zstd")
+# Arrow IPC codec: none (default, needed for zero-copy memory-mapped reads), zstd or lz4
+arrow_compression = os.getenv("arrow_compression", "none")
+
+columnar_extensions = {"parquet": "parquet", "arrow": "arrow"}
+
+# Bump when the table content changes, so cached files are regenerated
+columnar_cache_variant = f"columnar-1:{columnar_format}:parquet={parquet_compression}:arrow={arrow_compression}"
+
+# Local zip header layout: 30 fixed bytes, then the file name and extra field
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+# Function to convert one DataFrame column into a typed Arrow array.
+# Numeric, boolean and datetime columns keep their type (missing values become nulls);
+# everything else is stored as strings.
+def to_typed_column(series):
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred in ("floating", "integer", "mixed-integer-float", "decimal", "boolean", "datetime", "datetime64"):
+        try:
+            return pa.array(series, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+    return pa.array(series.where(series.isna(), series.astype(str)), type=pa.string(), from_pandas=True)
+
+# Function to build the Arrow table for one collection's documents.
+# A typed "Time" column (null when the timestamp is invalid) is added next to the original "Timestamp" text.
+def documents_to_table(documents):
+    df = pd.DataFrame(list(documents))
+    if '_id' in df.columns:
+        df = df.drop(columns='_id')
+    columns = {name: to_typed_column(df[name]) for name in df.columns}
+    if 'Timestamp' in df.columns:
+        columns['Time'] = pa.array(parse_timestamp_column(df['Timestamp']), type=pa.timestamp('s'))
+    return pa.table(columns)
+
+# Function to write a table to a local file in the configured columnar format
+def write_table(table, path):
+    if columnar_format == "arrow":
+        compression = None if arrow_compression == "none" else arrow_compression
+        with ipc.new_file(path, table.schema, options=ipc.IpcWriteOptions(compression=compression)) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, path, compression=parquet_compression)
+
+# Function to get the archive member name of a collection
+def get_columnar_arcname(collection_name):
+    return f'{sanitize_collection_name(collection_name)}.{columnar_extensions[columnar_format]}'
+
+# Function to write a collection's documents into the archive, recording the file in the cache if given.
+# Returns the number of rows written.
+def write_documents_to_columnar_zip(zipf, arcname, documents, staging_dir, collection_name=None,
+                                    fingerprint=None, cache=None):
+    staged_path = os.path.join(staging_dir, arcname)
+    table = documents_to_table(documents)
+    write_table(table, staged_path)
+    zipf.write(staged_path, arcname)
+    if cache is not None:
+        cache.store(collection_name, fingerprint, staged_path)
+    os.remove(staged_path)
+    return table.num_rows
+
+# Function to add a collection's cached columnar file to the archive when its fingerprint is unchanged
+def restore_cached_table(zipf, arcname, collection_name, fingerprint, cache, staging_dir):
+    staged_path = os.path.join(staging_dir, arcname)
+    if not cache.restore(collection_name, fingerprint, staged_path):
+        return False
+    zipf.write(staged_path, arcname)
+    os.remove(staged_path)
+    return True
+
+# Function to read every table of a downloaded parquet_files.zip without extracting it.
+# The archive is memory-mapped and each stored member is read straight from the mapping;
+# Arrow IPC members written without compression are not copied at all.
+# Returns {member name without extension: pyarrow.Table}; the tables keep the mapping alive.
+def read_columnar_archive(zip_path, names=None):
+    tables = {}
+    with open(zip_path, 'rb') as f, zipfile.ZipFile(f) as zipf:
+        archive = pa.py_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        for info in zipf.infolist():
+            name, extension = os.path.splitext(info.filename)
+            if names is not None and name not in names:
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Archive member '{info.filename}' is compressed and cannot be memory-mapped.")
+            header = ZIP_LOCAL_HEADER.unpack(archive[info.header_offset:info.header_offset + ZIP_LOCAL_HEADER.size].to_pybytes())
+            start = info.header_offset + ZIP_LOCAL_HEADER.size + header[-2] + header[-1]
+            member = pa.BufferReader(archive.slice(start, info.file_size))
+            if extension == ".arrow":
+                tables[name] = ipc.open_file(member).read_all()
+            else:
+                tables[name] = pq.read_table(member)
+    return tables
+
+# Function to download the latest parquet_files.zip from MongoDB and memory-map it
+def load_columnar_archive(zip_db, zip_path='parquet_files.zip', names=None):
+    with open(zip_path, 'wb') as f:
+        download_archive(zip_db, 'parquet_files', 'parquet_files.zip', f)
+    return read_columnar_archive(zip_path, names)
+
+def main():
+    # Connect to MongoDB
+    client = pymongo.MongoClient(target_mongo_url)
+    db = client[target_db_name]
+
+    # Connect to the target MongoDB database for storing the zip file
+    zip_db = client['zip_files']
+    run_id = get_run_id()
+    report = start_run_report("load_parquet_file", run_id)
+
+    # Unchanged collections reuse their cached file instead of being fetched again
+    cache = open_artifact_cache("parquet", client)
+    staging_dir = tempfile.mkdtemp()
+
+    collection_names = list_machine_collections(db)
+    total_collections = len(collection_names)
+    with report.span("export") as export_span, GridFSArchiveSink(zip_db, 'parquet_files', 'parquet_files.zip', run_id) as sink:
+        # ZIP_STORED: the members are already compressed and must stay memory-mappable
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zipf:
+            for index, collection_name in enumerate(collection_names, start=1):
+                arcname = get_columnar_arcname(collection_name)
+                fingerprint = None
+                if cache is not None:
+                    fingerprint = get_collection_fingerprint(db, collection_name, columnar_cache_variant)
+                    if restore_cached_table(zipf, arcname, collection_name, fingerprint, cache, staging_dir):
+                        report.count("cached_collections")
+                        print(f"Reused cached {arcname}. ({index} out of {total_collections} files)")
+                        continue
+                with report.span("encode", collection_name) as span:
+                    row_count = write_documents_to_columnar_zip(zipf, arcname, find_documents(db, collection_name, "parquet"),
+                                                                staging_dir, collection_name, fingerprint, cache)
+                    span["documents"] = row_count
+                export_span["documents"] += row_count
+                print(f"Data saved to {arcname} ({row_count} rows) successfully. ({index} out of {total_collections} files)")
+
+        export_span["bytes"] = sink.size
+
+    os.rmdir(staging_dir)
+    if cache is not None:
+        cache.close()
+
+    print("Zip file has been saved to MongoDB successfully.")
+
+    # Only drop the previous archive once the new one is fully uploaded
+    delete_old_archives(zip_db, 'parquet_files', keep_run_id=run_id)
+    report.finish(zip_db)
+
+    # Close the MongoDB connection
+    client.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import json
+import os
+import re
+from datetime import datetime
+from itertools import islice
+
+from bson import ObjectId, json_util
+from bson.codec_options import CodecOptions, TypeDecoder, TypeRegistry
+from bson.raw_bson import RawBSONDocument
+
+# Shared read layer for the scripts: each consumer asks only for the fields it uses, and
+# type conversion (ObjectId -> str for the exports, dates -> extended JSON for the source
+# load) happens inside the BSON decoder instead of in a second pass over every document.
+
+# Documents per cursor batch; unset leaves the server default
+read_batch_size = int(os.getenv("read_batch_size", "0")) or None
+
+# Chunked mode for very large collections: with chunk_memory_budget_mb set, the Excel and chart
+# exports read a collection in chunks sized to this budget and process one chunk at a time instead
+# of holding every document (and its DataFrame copies) at once. 0 reads whole collections.
+chunk_memory_budget_mb = int(os.getenv("chunk_memory_budget_mb", "0"))
+# Memory a document takes while a chunk is processed (decoded dict, DataFrame and cleaned copy),
+# as a multiple of its BSON size
+chunk_memory_factor = 10
+min_chunk_documents = 100
+
+# Full rebuilds are staged next to the live collections under this prefix (see load_json.py) and
+# renamed over them once complete; readers never take them for machine collections
+STAGING_PREFIX = "_staging."
+MACHINE_COLLECTION_FILTER = {"name": {"$not": {"$regex": f"^{re.escape(STAGING_PREFIX)}"}}}
+
+# Function to list the machine collections of a database (sync or async), leaving out staged rebuilds
+def list_machine_collections(db):
+    return db.list_collection_names(filter=MACHINE_COLLECTION_FILTER)
+
+# Fields each consumer needs; None means the whole document
+CONSUMER_PROJECTIONS = {
+    # load_json.py: the source fields used by format_documents, plus _id for the watermarks
+    "source": {"_id": 1, "name": 1, "rentability": 1, "power_consumption": 1, "updated_timestamp": 1,
+               "date": 1, "hash_rate": 1, "noise_level": 1, "algorithm": 1},
+    # load_json_file.py writes every field, _id included
+    "json": None,
+    # load_excel_file.py drops _id anyway
+    "excel": {"_id": 0},
+    # load_parquet_file.py stores every field except _id
+    "parquet": {"_id": 0},
+    # load_img_files.py only plots these three fields
+    "chart": {"_id": 0, "Timestamp": 1, "Profits Per Day ($)": 1, "Profits Without Expenses ($)": 1},
+}
+
+# Decoder turning every ObjectId into its string form while the BSON is decoded
+class ObjectIdToStrDecoder(TypeDecoder):
+    bson_type = ObjectId
+
+    def transform_bson(self, value):
+        return str(value)
+
+# Decoder turning dates into the same {"$date": ...} value the old json_util round trip produced
+class DatetimeToExtendedJsonDecoder(TypeDecoder):
+    bson_type = datetime
+
+    def transform_bson(self, value):
+        return json.loads(json_util.dumps(value))
+
+CONSUMER_CODEC_OPTIONS = {
+    "source": CodecOptions(type_registry=TypeRegistry([DatetimeToExtendedJsonDecoder()])),
+    "json": CodecOptions(type_registry=TypeRegistry([ObjectIdToStrDecoder()])),
+    "excel": CodecOptions(type_registry=TypeRegistry([ObjectIdToStrDecoder()])),
+    "parquet": CodecOptions(type_registry=TypeRegistry([ObjectIdToStrDecoder()])),
+    "chart": CodecOptions(),
+}
+
+# Function to combine the projections of several consumers reading the same collection once
+def get_projection(consumers):
+    projections = [CONSUMER_PROJECTIONS[consumer] for consumer in consumers]
+    if not projections or any(projection is None for projection in projections):
+        return None
+    # An exclusion-only projection ({"_id": 0}) means "everything else", so it wins over inclusions
+    if any(all(value == 0 for value in projection.values()) for projection in projections):
+        return {"_id": 0} if all(projection.get("_id", 1) == 0 for projection in projections) else None
+    combined = {}
+    for projection in projections:
+        for field, value in projection.items():
+            combined[field] = max(combined.get(field, 0), value)
+    return combined
+
+# Function to open a cursor on a collection for one consumer (or a list of consumers sharing one read)
+def find_documents(db, collection_name, consumer, query=None, sort=None, batch_size=None):
+    consumers = [consumer] if isinstance(consumer, str) else list(consumer)
+    # Consumers that write ObjectIds out need them as strings; the others do not mind either way
+    string_ids = any(consumer in ("json", "excel", "parquet") for consumer in consumers)
+    codec_options = CONSUMER_CODEC_OPTIONS["json" if string_ids else consumers[0]]
+    collection = db.get_collection(collection_name, codec_options=codec_options)
+    cursor = collection.find(query or {}, projection=get_projection(consumers))
+    if sort:
+        cursor = cursor.sort(sort)
+    batch_size = batch_size or read_batch_size
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    return cursor
+
+# Function to get how many documents of a collection fit in a chunk of budget_mb, from the size of one document
+def get_chunk_size(db, collection_name, consumer, budget_mb=None):
+    budget_bytes = (budget_mb or chunk_memory_budget_mb) * 1024 * 1024
+    consumers = [consumer] if isinstance(consumer, str) else list(consumer)
+    raw_collection = db.get_collection(collection_name, codec_options=CodecOptions(document_class=RawBSONDocument))
+    sample = raw_collection.find_one({}, projection=get_projection(consumers))
+    if sample is None:
+        return min_chunk_documents
+    return max(budget_bytes // (len(sample.raw) * chunk_memory_factor), min_chunk_documents)
+
+# Function to read a collection for one consumer as lists of documents of about budget_mb each.
+# Each chunk is one cursor batch, so the driver never buffers more than the chunk being processed.
+def iter_document_chunks(db, collection_name, consumer, query=None, sort=None, budget_mb=None):
+    chunk_size = get_chunk_size(db, collection_name, consumer, budget_mb)
+    cursor = find_documents(db, collection_name, consumer, query, sort, batch_size=chunk_size)
+    while True:
+        chunk = list(islice(cursor, chunk_size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,12 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Shared process pool setup for the Excel, chart and single-scan exports.
+
+# Function to create a process pool of workers processes, or None to run in this process
+def create_process_pool(workers, initializer=None, initargs=()):
+    if workers <= 1:
+        return None
+    # spawn, not fork: a forked child would inherit the parent's MongoClient, which is not fork-safe
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=initializer, initargs=initargs)
@@ -0,0 +1,178 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pymongo import ASCENDING, UpdateOne
+
+from mongo_reader import list_machine_collections
+from timestamp_utils import parse_timestamp_column
+
+# Per-machine hourly, daily and monthly aggregates of the formatted documents, kept in their own
+# database so the exporters never mistake them for machine collections. load_json.py folds every
+# batch of new documents into them with $min/$max/$inc upserts, so they are only recomputed for
+# machines they do not fully cover (see backfill_rollups); the exporters can read them instead of
+# scanning each machine's whole raw history.
+rollup_db_name = "channel_rollups"
+
+# Rollup collection -> strftime key of its period
+rollup_periods = {
+    "hourly": "%Y-%m-%dT%H",
+    "daily": "%Y-%m-%d",
+    "monthly": "%Y-%m",
+}
+
+# Formatted document field -> name of its aggregate in a rollup document
+rollup_metrics = {
+    "Profits Per Day ($)": "profits",
+    "Profits Without Expenses ($)": "full_profits",
+    "Electricity Bill Per Day ($)": "electricity_bill",
+}
+
+# Upserts sent per bulk_write call
+rollup_batch_size = int(os.getenv("rollup_batch_size", "1000"))
+# Raw documents folded at a time when rollups are rebuilt from a machine collection
+rollup_backfill_batch_size = int(os.getenv("rollup_backfill_batch_size", "50000"))
+
+# Number of raw documents folded into each machine's rollups ({_id: machine, documents: n}).
+# Rollups only count as complete when they cover every document of the machine collection, so
+# rollups started on a database that was already syncing are never read as the whole history.
+COVERAGE_COLLECTION = "coverage"
+
+# Function to aggregate formatted documents ({machine: [documents]}) per machine and period.
+# Returns {period name: DataFrame with machine, period, period_start and <metric>_min/_max/_sum/_count}.
+# Documents with an invalid timestamp are left out; missing metric values are not counted.
+def compute_rollups(grouped_data):
+    frames = [pd.DataFrame.from_records(documents, columns=["Timestamp"] + list(rollup_metrics)).assign(machine=machine)
+              for machine, documents in grouped_data.items() if documents]
+    if not frames:
+        return {}
+    df = pd.concat(frames, ignore_index=True)
+    df["time"] = parse_timestamp_column(df["Timestamp"])
+    df = df[df["time"].notna()].copy()
+    for field in rollup_metrics:
+        df[field] = pd.to_numeric(df[field], errors="coerce")
+
+    rollups = {}
+    for period_name, period_format in rollup_periods.items():
+        df["period"] = df["time"].dt.strftime(period_format)
+        grouped = df.groupby(["machine", "period"], sort=True)
+        aggregates = pd.DataFrame(index=grouped.size().index)
+        for field, metric in rollup_metrics.items():
+            aggregates[f"{metric}_min"] = grouped[field].min()
+            aggregates[f"{metric}_max"] = grouped[field].max()
+            aggregates[f"{metric}_sum"] = grouped[field].sum()
+            aggregates[f"{metric}_count"] = grouped[field].count()
+        # Start of the period itself, not of its first sample
+        aggregates["period_start"] = pd.to_datetime(aggregates.index.get_level_values("period"), format=period_format)
+        rollups[period_name] = aggregates.reset_index()
+    return rollups
+
+# Function to build the upsert folding one aggregated row into its rollup document
+def build_rollup_update(row):
+    update = {
+        "$setOnInsert": {"machine": row.machine, "period": row.period, "period_start": row.period_start.to_pydatetime()},
+        "$min": {},
+        "$max": {},
+        "$inc": {}
+    }
+    for metric in rollup_metrics.values():
+        count = int(getattr(row, f"{metric}_count"))
+        if count == 0:
+            continue
+        update["$min"][f"{metric}.min"] = float(getattr(row, f"{metric}_min"))
+        update["$max"][f"{metric}.max"] = float(getattr(row, f"{metric}_max"))
+        update["$inc"][f"{metric}.sum"] = float(getattr(row, f"{metric}_sum"))
+        update["$inc"][f"{metric}.count"] = count
+    return UpdateOne({"_id": f"{row.machine}|{row.period}"}, {key: value for key, value in update.items() if value},
+                     upsert=True)
+
+# Function to fold new formatted documents into the rollup collections of rollup_db
+# (collection_prefix names staged collections during a rebuild)
+def update_rollups(rollup_db, grouped_data, collection_prefix=""):
+    updated = 0
+    for period_name, aggregates in compute_rollups(grouped_data).items():
+        collection = rollup_db[collection_prefix + period_name]
+        collection.create_index([("machine", ASCENDING), ("period_start", ASCENDING)])
+        operations = [build_rollup_update(row) for row in aggregates.itertuples(index=False)]
+        for start in range(0, len(operations), rollup_batch_size):
+            collection.bulk_write(operations[start:start + rollup_batch_size], ordered=False)
+        updated += len(operations)
+    coverage = [UpdateOne({"_id": machine}, {"$inc": {"documents": len(documents)}}, upsert=True)
+                for machine, documents in grouped_data.items() if documents]
+    if coverage:
+        rollup_db[collection_prefix + COVERAGE_COLLECTION].bulk_write(coverage, ordered=False)
+    print(f"Updated {updated} rollup documents.")
+    return updated
+
+# Function to fold the documents of a machine collection read by cursor, in bounded batches
+def fold_documents(rollup_db, machine, cursor, collection_prefix=""):
+    batch = []
+    for document in cursor:
+        batch.append(document)
+        if len(batch) >= rollup_backfill_batch_size:
+            update_rollups(rollup_db, {machine: batch}, collection_prefix)
+            batch = []
+    if batch:
+        update_rollups(rollup_db, {machine: batch}, collection_prefix)
+
+# Function to find the fields the rollups use in a machine collection
+def find_rollup_fields(collection, query=None):
+    projection = {"_id": 0, "Timestamp": 1, **{field: 1 for field in rollup_metrics}}
+    return collection.find(query or {}, projection=projection, batch_size=rollup_batch_size)
+
+# Function to tell whether a machine's rollups cover every document of its raw collection exactly.
+# Folding more documents than the collection holds means some were folded twice, so that is stale too.
+def is_rollup_complete(folded_documents, collection):
+    return folded_documents is not None and folded_documents == collection.estimated_document_count()
+
+# Function to tell whether a machine has rollups covering its whole raw history in db
+def has_complete_rollups(db, rollup_db, machine):
+    coverage = rollup_db[COVERAGE_COLLECTION].find_one({"_id": machine})
+    return is_rollup_complete(coverage and coverage["documents"], db[machine])
+
+# Function to rebuild a machine's rollups from scratch from its raw collection
+def rebuild_machine_rollups(collection, rollup_db, machine, collection_prefix=""):
+    for period_name in rollup_periods:
+        rollup_db[collection_prefix + period_name].delete_many({"machine": machine})
+    rollup_db[collection_prefix + COVERAGE_COLLECTION].delete_one({"_id": machine})
+    fold_documents(rollup_db, machine, find_rollup_fields(collection), collection_prefix)
+
+# Function to rebuild the rollups of every machine collection of db they do not fully cover, e.g.
+# after rollups were enabled on a database that was already syncing. With collection_prefix, the
+# staged machine collections and rollups of a rebuild are used instead of the live ones. Machines in
+# skip_machines (partly written, retried next run) are left alone. Returns the machines rebuilt.
+def backfill_rollups(db, rollup_db, collection_prefix="", skip_machines=()):
+    coverage = {document["_id"]: document["documents"] for document in rollup_db[collection_prefix + COVERAGE_COLLECTION].find()}
+    if collection_prefix:
+        machines = [name[len(collection_prefix):] for name in db.list_collection_names() if name.startswith(collection_prefix)]
+    else:
+        machines = list_machine_collections(db)
+    rebuilt = []
+    for machine in machines:
+        if machine in skip_machines:
+            continue
+        collection = db[collection_prefix + machine]
+        if not is_rollup_complete(coverage.get(machine), collection):
+            print(f"Rebuilding the rollups of {machine} from its raw collection.")
+            rebuild_machine_rollups(collection, rollup_db, machine, collection_prefix)
+            rebuilt.append(machine)
+    return rebuilt
+
+# Function to read a machine's rollups of one period, oldest first
+def find_rollups(rollup_db, machine, period_name):
+    return list(rollup_db[period_name].find({"machine": machine}, sort=[("period_start", ASCENDING)]))
+
+# Function to turn rollup documents into flat report rows with the mean of every metric
+def rollups_to_rows(rollups):
+    rows = []
+    for rollup in rollups:
+        row = {"Period": rollup["period"]}
+        for field, metric in rollup_metrics.items():
+            values = rollup.get(metric, {})
+            count = values.get("count", 0)
+            row[f"{field} Min"] = values.get("min")
+            row[f"{field} Max"] = values.get("max")
+            row[f"{field} Mean"] = values["sum"] / count if count else np.nan
+            row[f"{field} Count"] = count
+        rows.append(row)
+    return rows
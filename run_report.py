@@ -0,0 +1,140 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Shared instrumentation for the scripts: timed spans per stage (fetch, transform, encode,
+# compress, upload, ...) and per collection, plain counters, documents and bytes processed and
+# peak RSS. Each script writes one machine-readable JSON run report when it finishes, to
+# <run_report_dir>/<script>_report.json, and with store_run_report=1 also into
+# zip_files.run_reports next to the archives.
+run_report_dir = os.getenv("run_report_dir", ".")
+store_run_report = os.getenv("store_run_report", "0") == "1"
+
+# Collections listed in the printed summary, slowest first
+slowest_collections_shown = 5
+
+# Function to get the peak resident set size in MB of this process and of its finished children
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+    }
+
+# Function to create an empty measurement bucket
+def new_measurement():
+    return {"seconds": 0.0, "calls": 0, "documents": 0, "bytes": 0, "errors": 0}
+
+# Measurements of one script run. Spans without a collection time a whole stage; spans with a
+# collection time that collection's share of a stage, so the two never double count.
+# Safe to use from several threads (the bulk writer records from its pool).
+class RunReport:
+    def __init__(self, script, run_id=None):
+        self.script = script
+        self.run_id = run_id
+        self.started_at = datetime.now(timezone.utc)
+        self.stages = {}
+        self.collections = {}
+        self.counters = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    # Function to add measurements to a stage, or to a collection's stage when collection is given.
+    # Used directly for work timed elsewhere, e.g. inside a worker process.
+    def add(self, stage, collection=None, seconds=0.0, documents=0, bytes=0, errors=0):
+        with self._lock:
+            buckets = self.stages if collection is None else self.collections.setdefault(collection, {})
+            measurement = buckets.setdefault(stage, new_measurement())
+            measurement["seconds"] += seconds or 0.0
+            measurement["calls"] += 1
+            measurement["documents"] += documents or 0
+            measurement["bytes"] += bytes or 0
+            measurement["errors"] += errors
+
+    # Context manager timing a block. The yielded dict takes the documents and bytes it processed:
+    #     with report.span("fetch", collection_name) as span:
+    #         span["documents"] = len(documents)
+    @contextmanager
+    def span(self, stage, collection=None):
+        metrics = {"documents": 0, "bytes": 0}
+        start = time.perf_counter()
+        try:
+            yield metrics
+        except BaseException:
+            self.add(stage, collection, time.perf_counter() - start, metrics["documents"], metrics["bytes"], errors=1)
+            raise
+        self.add(stage, collection, time.perf_counter() - start, metrics["documents"], metrics["bytes"])
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            stages = {}
+            for stage, measurement in self.stages.items():
+                stages[stage] = dict(measurement, seconds=round(measurement["seconds"], 3))
+                if measurement["seconds"] > 0 and measurement["documents"]:
+                    stages[stage]["documents_per_second"] = round(measurement["documents"] / measurement["seconds"], 1)
+            collections = {
+                collection: {stage: dict(measurement, seconds=round(measurement["seconds"], 3))
+                             for stage, measurement in stages_of_collection.items()}
+                for collection, stages_of_collection in self.collections.items()
+            }
+            return {
+                "script": self.script,
+                "run_id": self.run_id,
+                "started_at": self.started_at.isoformat(),
+                "wall_seconds": round(time.perf_counter() - self._start, 3),
+                "peak_rss_mb": get_peak_rss_mb(),
+                "stages": stages,
+                "collections": collections,
+                "counters": dict(self.counters)
+            }
+
+    # Function to print a summary, write the JSON report and optionally store it in zip_db.run_reports
+    def finish(self, zip_db=None):
+        report = self.to_dict()
+        print(f"[{self.script}] finished in {report['wall_seconds']:.2f} seconds, "
+              f"peak RSS {report['peak_rss_mb']['self']} MB (children {report['peak_rss_mb']['children']} MB).")
+        for stage, measurement in report["stages"].items():
+            rate = f", {measurement['documents_per_second']:.0f} documents/second" if "documents_per_second" in measurement else ""
+            print(f"  {stage}: {measurement['seconds']:.2f} s, {measurement['documents']} documents, "
+                  f"{measurement['bytes'] / 1024:.1f} KB{rate}")
+        totals = sorted(report["collections"].items(),
+                        key=lambda item: sum(measurement["seconds"] for measurement in item[1].values()), reverse=True)
+        for collection, stages_of_collection in totals[:slowest_collections_shown]:
+            print(f"  slow collection {collection}: "
+                  + ", ".join(f"{stage} {measurement['seconds']:.2f} s" for stage, measurement in stages_of_collection.items()))
+
+        os.makedirs(run_report_dir, exist_ok=True)
+        report_path = os.path.join(run_report_dir, f"{self.script}_report.json")
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Run report written to {report_path}.")
+
+        if store_run_report and zip_db is not None:
+            zip_db['run_reports'].insert_one(dict(report, started_at=self.started_at))
+            print("Run report stored in MongoDB.")
+        return report
+
+# The report of the running script
+current_report = None
+
+# Function to start the run report of a script
+def start_run_report(script, run_id=None):
+    global current_report
+    current_report = RunReport(script, run_id)
+    return current_report
+
+# Function to get the current run report; library code can always record into it
+def get_run_report():
+    if current_report is None:
+        return start_run_report(os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0])
+    return current_report
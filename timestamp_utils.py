@@ -0,0 +1,53 @@
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Format of the "Timestamp" field written by load_json.py, e.g. "Monday, Jan 01, 2024, 03 PM"
+TIMESTAMP_FORMAT = '%A, %b %d, %Y, %I %p'
+# Format used for timestamps in the Excel export
+OUTPUT_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+INVALID_TIMESTAMP = 'Invalid Timestamp'
+
+# Timestamps are hourly and shared by every machine, so a small cache covers months of history
+TIMESTAMP_CACHE_SIZE = 65536
+
+# Function to parse a timestamp string, memoized with LRU eviction.
+# Raises ValueError for invalid strings exactly like datetime.strptime.
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp_value(timestamp):
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+# Function to parse timestamp into the Excel output format, or 'Invalid Timestamp'
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def format_timestamp(timestamp):
+    try:
+        return parse_timestamp_value(timestamp).strftime(OUTPUT_TIMESTAMP_FORMAT)
+    except ValueError:
+        return INVALID_TIMESTAMP
+
+# Function to decode a whole column of timestamps into the Excel output format in one call.
+# Each distinct value is parsed once; missing values (NaN/None) are returned unchanged.
+# Same results as calling format_timestamp on every value.
+def format_timestamp_column(values):
+    values = pd.Series(values, dtype=object)
+    codes, uniques = pd.factorize(values)
+    formatted = np.array([format_timestamp(value) for value in uniques], dtype=object)
+    result = values.to_numpy(copy=True)
+    present = codes != -1
+    result[present] = formatted[codes[present]]
+    return result
+
+# Function to decode a whole column of timestamps into datetime64 values in one call,
+# with NaT wherever the value is missing or not a valid timestamp
+def parse_timestamp_column(values):
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    # One extra NaT slot at the end: factorize marks missing values with -1
+    parsed = np.full(len(uniques) + 1, np.datetime64('NaT'), dtype='datetime64[s]')
+    for idx, value in enumerate(uniques):
+        try:
+            parsed[idx] = parse_timestamp_value(value)
+        except (ValueError, TypeError):
+            pass
+    return parsed[codes]